@@ -0,0 +1,252 @@
+import asyncio
+import logging
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sink_worker import SinkWorker
+
+
+class LoopQueue:
+    # asyncio queue that sources can feed from their own threads
+    def __init__(self, loop):
+        self.loop = loop
+        self.queue = asyncio.Queue()
+
+    def put(self, item):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+
+    async def get(self):
+        return await self.queue.get()
+
+    def get_nowait(self):
+        return self.queue.get_nowait()
+
+    def empty(self):
+        return self.queue.empty()
+
+    def qsize(self):
+        return self.queue.qsize()
+
+
+class AsyncSinkWorker(SinkWorker):
+    def __init__(self, name, drain, store, queue_size=16, policy="drop", retry_interval=60):
+        super().__init__(name, drain, store, queue_size, policy, retry_interval)
+        self.queue_size = queue_size
+        self.loop = None
+        self.task = None
+
+    def start_task(self, loop, executor):
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self.task = loop.create_task(self.run_async(executor))
+
+    def notify(self, gvs):
+        # called from the dispatch executor thread
+        self.notified += len(gvs)
+        item = (time.time(), len(gvs))
+        if self.policy == "block":
+            asyncio.run_coroutine_threadsafe(self.queue.put(item), self.loop).result()
+        else:
+            self.loop.call_soon_threadsafe(self._put_nowait, item)
+
+    def _put_nowait(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def run_async(self, executor):
+        loop = asyncio.get_running_loop()
+        # drain what is left in the outbox from before a restart right away
+        ts_wake = time.time()
+        while True:
+            timeout = self.retry_interval
+            if ts_wake is not None:
+                timeout = max(0.0, ts_wake - time.time())
+            try:
+                await asyncio.wait_for(self.queue.get(), timeout)
+                while not self.queue.empty():
+                    self.queue.get_nowait()
+            except asyncio.TimeoutError:
+                pass
+
+            ts_start = time.time()
+            try:
+                ts_wake = await loop.run_in_executor(executor, self.drain)
+            except Exception as ex:
+                self.logger.error("Error delivering to %s" % self.name, exc_info=ex)
+                ts_wake = None
+            ts_end = time.time()
+            self.drains += 1
+            self.drain_seconds = ts_end - ts_start
+            await loop.run_in_executor(executor, self.update_lag, ts_end)
+
+
+class AsyncRuntime:
+    # Runs sources, dispatch and sinks as tasks of a single event loop, blocking
+    # serial, http and sqlite calls are made on a small fixed executor.
+    def __init__(self, dexpy):
+        self.logger = logging.getLogger('DEXPY')
+        self.dexpy = dexpy
+        self.stop_event = None
+
+    def run(self):
+        asyncio.run(self.main())
+
+    async def main(self):
+        dexpy = self.dexpy
+        loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        for sig in (signal.SIGHUP, signal.SIGINT):
+            loop.add_signal_handler(sig, self.stop_event.set)
+
+        executor = ThreadPoolExecutor(max_workers=3 + len(dexpy.sink_workers), thread_name_prefix="dexpy")
+        dexpy.callback_queue = LoopQueue(loop)
+
+        dexpy.start_mqtt()
+
+        source_tasks = []
+        if dexpy.dexcom_share_session is not None:
+            self.logger.info("starting monitoring dexcom share server")
+            source_tasks.append(loop.create_task(self.poll_share(executor)))
+
+        if dexpy.share_scheduler is not None:
+            self.logger.info("starting monitoring dexcom share accounts")
+            source_tasks.append(loop.create_task(self.poll_share_accounts()))
+
+        if dexpy.dexcom_receiver_session is not None:
+            self.logger.info("starting usb receiver service")
+            source_tasks.append(loop.create_task(self.poll_receiver(executor)))
+
+        for worker in dexpy.sink_workers.values():
+            worker.start_task(loop, executor)
+
+        dispatch_task = loop.create_task(self.dispatch(executor))
+
+        await self.stop_event.wait()
+        dexpy.exit_event.set()
+
+        self.logger.info("stopping sources")
+        for task in source_tasks:
+            task.cancel()
+        await asyncio.gather(*source_tasks, return_exceptions=True)
+
+        self.logger.info("processing remaining values")
+        dexpy.callback_queue.put(None)
+        await dispatch_task
+
+        for name, worker in dexpy.sink_workers.items():
+            self.logger.info("stopping %s sink worker" % name)
+            worker.task.cancel()
+        await asyncio.gather(*[worker.task for worker in dexpy.sink_workers.values()], return_exceptions=True)
+
+        executor.shutdown(wait=True)
+        dexpy.close_clients()
+
+    async def poll_share(self, executor):
+        loop = asyncio.get_running_loop()
+        session = self.dexpy.dexcom_share_session
+        await loop.run_in_executor(executor, session.open)
+        try:
+            while True:
+                try:
+                    request_wait = await loop.run_in_executor(executor, session.perform_request)
+                except Exception as ex:
+                    self.logger.error("Error polling dexcom share server", exc_info=ex)
+                    request_wait = 60
+                self.logger.debug("next request in %d seconds" % request_wait)
+                await asyncio.sleep(request_wait)
+        finally:
+            await loop.run_in_executor(None, session.close)
+
+    async def poll_share_accounts(self):
+        # the scheduler's heap drives the accounts, polls run on its own fixed pool
+        loop = asyncio.get_running_loop()
+        scheduler = self.dexpy.share_scheduler
+        executor = ThreadPoolExecutor(max_workers=scheduler.workers, thread_name_prefix="share")
+        wake = asyncio.Event()
+        polls = set()
+
+        async def poll(session):
+            wait = await loop.run_in_executor(executor, scheduler.poll, session)
+            self.logger.debug("next request for %s in %d seconds" % (session.name, wait))
+            scheduler.schedule(session, wait)
+            wake.set()
+
+        await loop.run_in_executor(executor, scheduler.open)
+        try:
+            while True:
+                for session in scheduler.pop_due(time.time()):
+                    task = loop.create_task(poll(session))
+                    polls.add(task)
+                    task.add_done_callback(polls.discard)
+                ts_next = scheduler.next_due()
+                wake.clear()
+                try:
+                    await asyncio.wait_for(wake.wait(), None if ts_next is None else max(0.0, ts_next - time.time()))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            for task in list(polls):
+                task.cancel()
+            # polls still in flight finish on their own, the loop doesn't wait for them
+            executor.shutdown(wait=False, cancel_futures=True)
+            await loop.run_in_executor(None, scheduler.close)
+
+    async def poll_receiver(self, executor):
+        loop = asyncio.get_running_loop()
+        session = self.dexpy.dexcom_receiver_session
+        wake = asyncio.Event()
+        session.on_wake = lambda: loop.call_soon_threadsafe(wake.set)
+        session.start_hotplug()
+        try:
+            while True:
+                wake.clear()
+                try:
+                    wait = await loop.run_in_executor(executor, session.poll)
+                except Exception as ex:
+                    self.logger.error("Error polling usb receiver", exc_info=ex)
+                    wait = 15
+                self.logger.debug("timer set to %d seconds" % wait)
+                try:
+                    await asyncio.wait_for(wake.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            session.stop_hotplug()
+
+    async def dispatch(self, executor):
+        loop = asyncio.get_running_loop()
+        queue = self.dexpy.callback_queue
+        max_delay = float(self.dexpy.args.BATCH_MAX_DELAY_MS) / 1000
+        max_size = int(self.dexpy.args.BATCH_MAX_SIZE)
+        stopping = False
+        while not stopping:
+            item = await queue.get()
+            if item is None:
+                break
+            account, gvs = item
+            batches = {account: list(gvs)}
+            count = len(gvs)
+
+            ts_deadline = time.time() + max_delay
+            while count < max_size:
+                if queue.empty():
+                    remaining = ts_deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(queue.get(), remaining)
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    item = queue.get_nowait()
+                if item is None:
+                    stopping = True
+                    break
+                account, gvs = item
+                batches.setdefault(account, []).extend(gvs)
+                count += len(gvs)
+
+            await loop.run_in_executor(executor, self.dexpy.process_batches, batches)
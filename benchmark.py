@@ -0,0 +1,312 @@
+#!/usr/bin/python3
+import argparse
+import gzip
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import shutil
+import signal
+import socketserver
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from glucose import GlucoseValue
+
+# End to end benchmark of the dexpy pipeline. Synthetic glucose value streams are
+# fed into DexPy.glucose_values_received and delivered to local stand-ins of an
+# mqtt broker, an influxdb /write endpoint and a nightscout /api/v1/entries
+# endpoint. Each scenario runs in its own process so peak RSS is per scenario.
+#
+#   python benchmark.py --output results.json
+#   python benchmark.py --scenario live --set RUNTIME=asyncio --set INFLUXDB_FLUSH_INTERVAL_MS=50
+
+SCENARIOS = ["live", "backfill", "duplicates"]
+INTERVAL = 300
+
+
+def percentile(values, q):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class Receipts:
+    # time each sink first received a value, by the value's st in whole seconds
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.received = {}
+        self.messages = {}
+
+    def add(self, sink, sts):
+        ts = time.time()
+        with self.lock:
+            received = self.received.setdefault(sink, {})
+            self.messages[sink] = self.messages.get(sink, 0) + 1
+            for st in sts:
+                received.setdefault(st, ts)
+
+    def count(self, sink):
+        with self.lock:
+            return len(self.received.get(sink, {}))
+
+
+class MqttBrokerHandler(socketserver.BaseRequestHandler):
+    # just enough mqtt 3.1.1 to accept a client's qos 1 publishes
+    def read(self, n):
+        data = b""
+        while len(data) < n:
+            chunk = self.request.recv(n - len(data))
+            if not chunk:
+                raise EOFError()
+            data += chunk
+        return data
+
+    def handle(self):
+        try:
+            while True:
+                header = self.read(1)[0]
+                length, shift = 0, 0
+                while True:
+                    b = self.read(1)[0]
+                    length |= (b & 0x7f) << shift
+                    shift += 7
+                    if not b & 0x80:
+                        break
+                body = self.read(length)
+                packet_type = header >> 4
+                if packet_type == 1:
+                    self.request.sendall(b"\x20\x02\x00\x00")
+                elif packet_type == 3:
+                    qos = (header >> 1) & 3
+                    topic_length = struct.unpack_from(">H", body)[0]
+                    offset = 2 + topic_length
+                    if qos > 0:
+                        packet_id = body[offset:offset + 2]
+                        offset += 2
+                    payload = body[offset:].decode("utf-8")
+                    self.server.receipts.add("mqtt", [int(payload.split("|")[0])])
+                    if qos == 1:
+                        self.request.sendall(b"\x40\x02" + packet_id)
+                elif packet_type == 8:
+                    self.request.sendall(b"\x90\x03" + body[:2] + b"\x00")
+                elif packet_type == 12:
+                    self.request.sendall(b"\xd0\x00")
+                elif packet_type == 14:
+                    return
+        except (EOFError, OSError):
+            return
+
+
+class MqttBroker(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, receipts):
+        super().__init__(("127.0.0.1", 0), MqttBrokerHandler)
+        self.receipts = receipts
+
+
+class HttpSinkHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        data = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if self.headers.get("Content-Encoding") == "gzip":
+            data = gzip.decompress(data)
+        path = self.path.split("?")[0]
+        if path == "/write":
+            sts = [int(line.rsplit(" ", 1)[1]) for line in data.decode("utf-8").splitlines() if line]
+            self.server.receipts.add("influx", sts)
+            self.respond(204, b"")
+        elif path.rstrip("/") == "/api/v1/entries":
+            entries = json.loads(data.decode("utf-8"))
+            self.server.receipts.add("ns", [int(round(e["date"] / 1000)) for e in entries])
+            self.respond(200, json.dumps(entries).encode("utf-8"))
+        else:
+            self.respond(404, b"")
+
+    def respond(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+class HttpSinks(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, receipts):
+        super().__init__(("127.0.0.1", 0), HttpSinkHandler)
+        self.receipts = receipts
+
+
+def stream(name, size, seed=0):
+    # yields lists of glucose values as sources hand them over, and the number of
+    # callbacks per second to send them at
+    rnd = random.Random(seed)
+    ts_end = int(time.time())
+
+    def gv(i):
+        st = ts_end - (size - i) * INTERVAL
+        return GlucoseValue(None, None, st, float(rnd.randint(40, 400)), rnd.randint(1, 7))
+
+    if name == "live":
+        # steady live traffic, one value per callback
+        return [[gv(i)] for i in range(size)], 200.0
+    if name == "backfill":
+        # 24h backfill bursts of 288 values, newest first as share returns them
+        values = [gv(i) for i in range(size)]
+        return [list(reversed(values[i:i + 288])) for i in range(0, size, 288)], 2.0
+    if name == "duplicates":
+        # every value is seen five times, partly with the receiver's timestamp jitter
+        values = [gv(i) for i in range(size)]
+        batches = []
+        for i, v in enumerate(values):
+            batches.append([v])
+            for _ in range(4):
+                j = max(0, i - rnd.randint(0, 3))
+                d = values[j]
+                batches.append([GlucoseValue(None, None, d.st + rnd.choice((0, 0, 1, -1)), d.value, d.trend)])
+        return batches, 1000.0
+    raise ValueError("unknown scenario %s" % name)
+
+
+def run_scenario(name, size, overrides, timeout):
+    import dexpy
+
+    receipts = Receipts()
+    broker = MqttBroker(receipts)
+    sinks = HttpSinks(receipts)
+    for server in (broker, sinks):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    db_dir = tempfile.mkdtemp(prefix="dexpy-bench-")
+    argv = ["--DB-PATH", os.path.join(db_dir, "bench.db"), "--USB-RECEIVER", "",
+            "--MQTT-SERVER", "127.0.0.1", "--MQTT-PORT", str(broker.server_address[1]),
+            "--MQTT-CLIENTID", "dexpy-bench",
+            "--INFLUXDB-SERVER", "127.0.0.1", "--INFLUXDB-PORT", str(sinks.server_address[1]),
+            "--INFLUXDB-DATABASE", "bench", "--INFLUXDB-MEASUREMENT", "cgm",
+            "--NIGHTSCOUT-URL", "http://127.0.0.1:%d" % sinks.server_address[1]]
+    args = dexpy.parse_args(argv)
+    for key, value in overrides.items():
+        args.__dict__[key] = value
+    app = dexpy.DexPy(args)
+    sink_names = list(app.sink_workers.keys())
+
+    batches, rate = stream(name, size)
+    enqueued = {}
+    result = {}
+
+    def feed():
+        ts_wait = time.time() + 10
+        while not app.mqtt_connected and time.time() < ts_wait:
+            time.sleep(0.01)
+        ts_start = time.time()
+        for i, batch in enumerate(batches):
+            ts_due = ts_start + i / rate
+            delay = ts_due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            ts = time.time()
+            for gv in batch:
+                enqueued.setdefault(int(gv.st), ts)
+            app.glucose_values_received(batch)
+        ts_fed = time.time()
+
+        ts_deadline = ts_fed + timeout
+        while time.time() < ts_deadline and any(receipts.count(s) < size for s in sink_names):
+            time.sleep(0.01)
+        result.update(ts_start=ts_start, ts_fed=ts_fed)
+        os.kill(os.getpid(), signal.SIGINT)
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    try:
+        app.run()
+        feeder.join()
+    finally:
+        shutil.rmtree(db_dir, ignore_errors=True)
+    broker.shutdown()
+    sinks.shutdown()
+
+    ts_start = result["ts_start"]
+    ts_last_ack = max([max(receipts.received.get(s, {}).values() or [ts_start]) for s in sink_names])
+    report = {
+        "callbacks": len(batches),
+        "values_enqueued": sum(len(b) for b in batches),
+        "unique_values": size,
+        "feed_seconds": round(result["ts_fed"] - ts_start, 3),
+        "seconds": round(ts_last_ack - ts_start, 3),
+        "throughput_values_per_second": round(size / max(1e-9, ts_last_ack - ts_start), 1),
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "cpu_seconds": round(time.process_time(), 3),
+        "sinks": {},
+    }
+    for sink in sink_names:
+        received = receipts.received.get(sink, {})
+        latencies = [(ts - enqueued[st]) * 1000 for st, ts in received.items() if st in enqueued]
+        report["sinks"][sink] = {
+            "delivered": len(received),
+            "requests": receipts.messages.get(sink, 0),
+            "latency_ms_p50": round(percentile(latencies, 0.5) or 0, 2),
+            "latency_ms_p99": round(percentile(latencies, 0.99) or 0, 2),
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="dexpy end to end pipeline benchmark")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS,
+                        help="scenarios to run, all of them by default")
+    parser.add_argument("--size", type=int, default=2880, help="unique glucose values per scenario")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                        help="dexpy configuration value, e.g. RUNTIME=asyncio")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds to wait for the sinks")
+    parser.add_argument("--output", default=None, help="json file to write the results to")
+    parser.add_argument("--run-scenario", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    overrides = dict(item.split("=", 1) for item in args.set)
+    logging.getLogger('DEXPY').setLevel(logging.WARNING)
+
+    if args.run_scenario is not None:
+        print(json.dumps(run_scenario(args.run_scenario, args.size, overrides, args.timeout)))
+        return
+
+    try:
+        version = subprocess.check_output(["git", "describe", "--always", "--dirty"],
+                                          cwd=os.path.dirname(os.path.abspath(__file__)),
+                                          stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        version = None
+    results = {"version": version, "python": platform.python_version(), "machine": platform.machine(),
+               "size": args.size, "config": overrides, "scenarios": {}}
+    for name in args.scenario or SCENARIOS:
+        command = [sys.executable, os.path.abspath(__file__), "--run-scenario", name, "--size", str(args.size),
+                   "--timeout", str(args.timeout)] + ["--set=" + item for item in args.set]
+        output = subprocess.check_output(command, cwd=os.path.dirname(os.path.abspath(__file__)))
+        results["scenarios"][name] = json.loads(output.decode().strip().splitlines()[-1])
+
+    text = json.dumps(results, indent=2)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import math
+import time
+from collections import deque
+
+
+class ClockSync:
+    # Estimates the offset between host and receiver clocks from occasional
+    # samples of the receiver time. Each sample is taken at the middle of the
+    # round trip, a least squares fit over recent samples tracks the drift and
+    # a new sample is only requested when the fitted offset is too uncertain.
+    #
+    # The receiver reports whole seconds, its clock is on average half a second
+    # ahead of the value read.
+    QUANTIZATION = 0.5
+    # limit for the fitted drift, a few samples seconds apart would otherwise
+    # turn the rounding of the receiver time into large drift estimates
+    MAX_DRIFT = 100e-6
+
+    def __init__(self, window=8, max_uncertainty=1.0, min_interval=300, max_interval=6 * 60 * 60,
+                 max_rtt=1.0, max_jump=5.0):
+        self.samples = deque(maxlen=window)
+        self.max_uncertainty = max_uncertainty
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_rtt = max_rtt
+        self.max_jump = max_jump
+        self.sample_count = 0
+        self.ts_ref = None
+        self.fit = None
+
+    def sample(self, read_device_time):
+        ts_start = time.time()
+        device_time = read_device_time()
+        ts_end = time.time()
+        return self.add_sample(ts_start, device_time, ts_end)
+
+    def add_sample(self, ts_start, device_time, ts_end):
+        rtt = ts_end - ts_start
+        ts_mid = ts_start + rtt / 2
+        offset = ts_mid - (device_time + self.QUANTIZATION)
+        self.sample_count += 1
+        if rtt > self.max_rtt and len(self.samples) > 0:
+            return False
+        if len(self.samples) > 0 and abs(offset - self.offset(ts_mid)) > self.max_jump:
+            # either clock was set, start over
+            self.samples.clear()
+        if len(self.samples) == 0:
+            self.ts_ref = ts_mid
+        self.samples.append((ts_mid - self.ts_ref, offset, rtt))
+        self.fit = self._fit()
+        return True
+
+    def _fit(self):
+        n = len(self.samples)
+        x_mean = sum(s[0] for s in self.samples) / n
+        y_mean = sum(s[1] for s in self.samples) / n
+        sxx = sum((s[0] - x_mean) ** 2 for s in self.samples)
+        if n < 2 or sxx <= 0:
+            slope = 0.0
+        else:
+            slope = sum((s[0] - x_mean) * (s[1] - y_mean) for s in self.samples) / sxx
+            slope = max(-self.MAX_DRIFT, min(self.MAX_DRIFT, slope))
+        # error of a single sample: rounding of the receiver time and half the round trip
+        sigma = math.sqrt(self.QUANTIZATION ** 2 / 3 + (sum(s[2] for s in self.samples) / n / 2) ** 2)
+        if n > 2:
+            residual = sum((s[1] - y_mean - slope * (s[0] - x_mean)) ** 2 for s in self.samples)
+            sigma = max(sigma, math.sqrt(residual / (n - 2)))
+        return x_mean, y_mean, slope, sxx, sigma, n
+
+    def offset(self, ts_now=None):
+        # seconds to add to the receiver time to get host time
+        if self.fit is None:
+            return None
+        if ts_now is None:
+            ts_now = time.time()
+        x_mean, y_mean, slope, sxx, sigma, n = self.fit
+        return y_mean + slope * (ts_now - self.ts_ref - x_mean)
+
+    def uncertainty(self, ts_now=None):
+        if self.fit is None:
+            return float('inf')
+        if ts_now is None:
+            ts_now = time.time()
+        x_mean, y_mean, slope, sxx, sigma, n = self.fit
+        dx = ts_now - self.ts_ref - x_mean
+        if n < 2 or sxx <= 0:
+            return sigma + self.MAX_DRIFT * abs(dx)
+        return sigma * math.sqrt(1.0 / n + dx * dx / sxx)
+
+    def needs_sample(self, ts_now=None):
+        if self.fit is None:
+            return True
+        if ts_now is None:
+            ts_now = time.time()
+        age = ts_now - self.ts_ref - self.samples[-1][0]
+        if age >= self.max_interval:
+            return True
+        if age < self.min_interval:
+            return False
+        return len(self.samples) < 2 or self.uncertainty(ts_now) > self.max_uncertainty
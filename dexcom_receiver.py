@@ -1,15 +1,44 @@
+import collections
 import os
+import sys
 import time
 from glucose import GlucoseValue
 import threading
 import logging
 
+from clocksync import ClockSync
 from usbreceiver import constants
+from usbreceiver.deviceinfo import DeviceInfoCache
+from usbreceiver.hotplug import HotplugWatcher
+from usbreceiver.pagecache import PageCache
 from usbreceiver.readdata import Dexcom
+from usbreceiver.util import LatencyHistogram
+
+EMPTY_PAGE_RANGE = 0xFFFFFFFF
+# wait while no receiver is attached and hotplug events will wake us up
+IDLE_WAIT = 300
+
+
+class PageCursor():
+    def __init__(self, page, records):
+        self.page = page
+        self.count = len(records)
+        self.key = self.record_key(records[-1])
+
+    @staticmethod
+    def record_key(record):
+        try:
+            return record.system_secs, record.testNum
+        except IndexError:
+            return record.system_secs, None
+
+    def matches(self, record):
+        return self.record_key(record) == self.key
 
 
 class DexcomReceiverSession():
-    def __init__(self, callback, usb_reset_cmd = None):
+    def __init__(self, callback, usb_reset_cmd = None, page_cache_bytes = 1024 * 1024,
+                 timeout = Dexcom.DEFAULT_TIMEOUT, page_timeout = None, retries = 2, port_path = None):
         self.logger = logging.getLogger('DEXPY')
         self.callback = callback
         self.device = None
@@ -18,19 +47,71 @@ class DexcomReceiverSession():
         self.initial_backfill_executed = False
         self.last_gv = None
         self.system_time_offset = None
+        self.clock_sync = ClockSync()
+        self.cursors = {}
+        self.page_cache = None
+        if page_cache_bytes:
+            self.page_cache = PageCache(max_bytes=page_cache_bytes)
+        self.device_info_cache = DeviceInfoCache()
         self.usb_reset_cmd = usb_reset_cmd
+        self.timeout = timeout
+        self.timeouts = {}
+        if page_timeout is not None:
+            self.timeouts[constants.READ_DATABASE_PAGES] = page_timeout
+        self.retries = retries
+        # kept across reconnects, shared with every Dexcom instance
+        self.command_latencies = collections.defaultdict(LatencyHistogram)
+        self.poll_latency = LatencyHistogram()
         self.ts_usb_reset = time.time() + 360
+        self.port_path = port_path
+        self.hotplug = None
+        if port_path is None and sys.platform.startswith("linux"):
+            self.hotplug = HotplugWatcher(self.on_hotplug)
+        self.on_wake = self.wake_timer
 
     def start_monitoring(self):
+        self.start_hotplug()
         self.on_timer()
 
+    def start_hotplug(self):
+        if self.hotplug is not None:
+            self.hotplug.start()
+
+    def stop_hotplug(self):
+        if self.hotplug is not None:
+            self.hotplug.stop()
+
+    def on_hotplug(self, port):
+        if port is not None and self.device is None:
+            self.on_wake()
+
+    def wake_timer(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.set_timer(0)
+
     def on_timer(self):
+        with self.lock:
+            self.set_timer(self.poll())
+
+    def poll(self) -> float:
+        ts_start = time.time()
+        try:
+            return self.poll_device()
+        finally:
+            self.poll_latency.observe(time.time() - ts_start)
+
+    def poll_device(self) -> float:
         with self.lock:
             if not self.ensure_connected():
-                self.set_timer(15)
+                if self.device is None and self.hotplug is not None and self.hotplug.listening \
+                        and self.hotplug.port is None:
+                    return IDLE_WAIT
+                return 15
             elif self.read_glucose_values():
                 self.ts_usb_reset = time.time() + 360
-                self.set_timer(30)
+                return 30
             else:
                 if self.usb_reset_cmd is not None:
                     ts_now = time.time()
@@ -39,25 +120,46 @@ class DexcomReceiverSession():
                         os.system(self.usb_reset_cmd)
                         ts_now = time.time()
                         self.ts_usb_reset = ts_now + 360
-                self.set_timer(10)
+                return 10
 
     def ensure_connected(self):
         try:
             if self.device is None:
-                port = Dexcom.FindDevice()
+                if self.port_path is not None:
+                    port = self.port_path
+                elif self.hotplug is not None:
+                    port = self.hotplug.find_port()
+                else:
+                    port = Dexcom.FindDevice()
                 if port is None:
                     self.logger.warning("Dexcom receiver not found")
                     return False
                 else:
-                    self.device = Dexcom(port)
-            self.system_time_offset = self.get_device_time_offset()
+                    self.device = Dexcom(port, page_cache=self.page_cache, timeout=self.timeout,
+                                         timeouts=self.timeouts, retries=self.retries,
+                                         device_info_cache=self.device_info_cache,
+                                         latencies=self.command_latencies)
+                    # confirms the clock of a receiver that might have been replaced
+                    self.clock_sync.sample(self.device.ReadSystemTime)
+            ts_now = time.time()
+            if self.clock_sync.needs_sample(ts_now):
+                self.clock_sync.sample(self.device.ReadSystemTime)
+            self.system_time_offset = self.clock_sync.offset(ts_now)
             return True
         except Exception as e:
             self.logger.warning("Error reading from usb device\n" + str(e))
-            self.device = None
-            self.system_time_offset = None
+            self.disconnect()
             return False
 
+    def disconnect(self):
+        if self.device is not None:
+            try:
+                self.device.Disconnect()
+            except Exception:
+                pass
+        self.device = None
+        self.system_time_offset = None
+
     def set_timer(self, seconds):
         self.timer = threading.Timer(seconds, self.on_timer)
         self.timer.setDaemon(True)
@@ -65,8 +167,11 @@ class DexcomReceiverSession():
         self.timer.start()
 
     def stop_monitoring(self):
+        self.stop_hotplug()
         with self.lock:
-            self.timer.cancel()
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
 
     def read_glucose_values(self, ts_cut_off: float = None):
         try:
@@ -76,45 +181,76 @@ class DexcomReceiverSession():
                 else:
                     ts_cut_off = time.time() - 24 * 60 * 60
 
-            records = self.device.iter_records('EGV_DATA')
+            gvs = []
             new_value_received = False
-
-            for rec in records:
+            for rec in self.read_new_records('EGV_DATA', ts_cut_off):
                 if not rec.display_only:
                     gv = self._as_gv(rec)
-                    if self.last_gv is None or self.last_gv.st != gv.st:
+                    if self.last_gv is None or self.last_gv.st < gv.st:
                         self.last_gv = gv
                         new_value_received = True
-                    self.callback([gv])
-                    break
+                    if gv.st >= ts_cut_off:
+                        gvs.append(gv)
 
-            if new_value_received:
-                for rec in records:
+            if 'BACKFILLED_EGV' in self.device.PARSER_MAP:
+                for rec in self.read_new_records('BACKFILLED_EGV', ts_cut_off):
                     if not rec.display_only:
                         gv = self._as_gv(rec)
                         if gv.st >= ts_cut_off:
-                            self.callback([gv])
-                        else:
-                            break
+                            gvs.append(gv)
 
-                for rec in self.device.iter_records('BACKFILLED_EGV'):
-                    if not rec.display_only:
-                        gv = self._as_gv(rec)
-                        if gv.st >= ts_cut_off:
-                            self.callback([gv])
-                        else:
-                            break
+            if len(gvs) > 0:
+                self.callback(gvs)
 
             self.initial_backfill_executed = True
             return new_value_received
         except Exception as e:
             self.logger.warning("Error reading from usb device\n" + str(e))
+            # the clock is no longer read on every poll to notice a lost device
+            self.disconnect()
             return False
 
-    def get_device_time_offset(self):
-        now_time = time.time()
-        device_time = self.device.ReadSystemTime()
-        return now_time - device_time
+    def read_new_records(self, record_type, ts_cut_off):
+        # Returns the records added since the last call in chronological order.
+        # The cursor remembers the last page read, how many records it had and the
+        # identity of the last of them, so only the tail of the database is read again.
+        start, end = self.device.ReadDatabasePageRange(record_type)
+        if start == EMPTY_PAGE_RANGE or end == EMPTY_PAGE_RANGE:
+            self.cursors.pop(record_type, None)
+            return []
+
+        cursor = self.cursors.get(record_type)
+        records = None
+        if cursor is not None and start <= cursor.page <= end:
+            page_records = list(self.device.ReadDatabasePage(record_type, cursor.page))
+            if len(page_records) >= cursor.count and cursor.matches(page_records[cursor.count - 1]):
+                records = page_records[cursor.count:]
+                last_page, last_page_records = cursor.page, page_records
+                for page, page_records in self.device.IterPages(record_type, cursor.page + 1, end + 1):
+                    last_page, last_page_records = page, list(page_records)
+                    records.extend(last_page_records)
+            else:
+                self.logger.debug("%s changed on the receiver, reading again" % record_type)
+
+        if records is None:
+            records = []
+            last_page, last_page_records = end, None
+            for page, page_records in self.device.IterPages(record_type, start, end + 1, reverse=True):
+                page_records = list(page_records)
+                if last_page_records is None:
+                    last_page_records = page_records
+                records[0:0] = page_records
+                if len(page_records) > 0 and self._record_ts(page_records[0]) < ts_cut_off:
+                    break
+
+        if len(last_page_records) > 0:
+            self.cursors[record_type] = PageCursor(last_page, last_page_records)
+        else:
+            self.cursors.pop(record_type, None)
+        return records
+
+    def _record_ts(self, record):
+        return record.meter_time + self.system_time_offset
 
     def _as_gv(self, record):
         st = record.meter_time + self.system_time_offset
@@ -1,39 +1,59 @@
+import heapq
+import itertools
 import logging
 import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
+from requests.adapters import HTTPAdapter
 import json
 from glucose import GlucoseValue
 import time
 
+from usbreceiver.util import LatencyHistogram
+
 
 # Dexcom Share API credits:
 # https://gist.github.com/StephenBlackWasAlreadyTaken/adb0525344bedade1e25
 
 class DexcomShareSession():
-    def __init__(self, location, username, password, callback):
+    def __init__(self, location, username, password, callback, base_url=None, name=None, http_session=None,
+                 rate_limiter=None, request_timeout=None):
         self.logger = logging.getLogger('DEXPY')
         self.callback = callback
+        self.name = name
 
-        if location == "us":
-            self.address = "share2.dexcom.com"
+        if base_url is not None:
+            self.base_url = base_url.rstrip("/")
+        elif location == "us":
+            self.base_url = "https://share2.dexcom.com"
         elif location == "eu":
-            self.address = "shareous1.dexcom.com"
+            self.base_url = "https://shareous1.dexcom.com"
         else:
             raise ValueError("Unknown location type")
 
         self.username = username
         self.password = password
         self.session = None
+        # a session shared with other accounts is not closed or replaced by this one
+        self.http_session = http_session
+        self.rate_limiter = rate_limiter
+        self.request_timeout = request_timeout
         self.dexcom_session_id = None
 
         self.lock = threading.RLock()
         self.timer = None
         self.initial_backfill_executed = False
         self.gvs = []
+        self.last_gv = None
+
+        self.requests = 0
+        self.logins = 0
+        self.backfills = 0
+        self.poll_latency = LatencyHistogram()
 
     def start_monitoring(self):
-        self.session = requests.Session()
-        self.logger.info("started dexcom share client")
+        self.open()
         self.on_timer()
 
     def stop_monitoring(self):
@@ -42,7 +62,18 @@ class DexcomShareSession():
                 self.timer.cancel()
                 self.timer = None
 
-        self.session.close()
+        self.close()
+
+    def open(self):
+        if self.http_session is not None:
+            self.session = self.http_session
+        else:
+            self.session = requests.Session()
+        self.logger.info("started dexcom share client%s" % ("" if self.name is None else " for " + self.name))
+
+    def close(self):
+        if self.http_session is None:
+            self.session.close()
 
     def on_timer(self):
         with self.lock:
@@ -53,6 +84,13 @@ class DexcomShareSession():
             self.timer.start()
 
     def perform_request(self) -> float:
+        ts_start = time.time()
+        try:
+            return self.request_values()
+        finally:
+            self.poll_latency.observe(time.time() - ts_start)
+
+    def request_values(self) -> float:
         if self.dexcom_session_id is None:
             self.login()
 
@@ -64,6 +102,8 @@ class DexcomShareSession():
         if gv is None:
             self.logger.warning("Received no glucose value")
         else:
+            if self.last_gv is None or self.last_gv.st < gv.st:
+                self.last_gv = gv
             if len(self.gvs) == 0 or self.gvs[-1].__ne__(gv):
                 self.gvs.append(gv)
                 self.callback([gv])
@@ -93,6 +133,7 @@ class DexcomShareSession():
         else:
             self.logger.info("Executing initial backfill with the last 24 hours of data..")
             gvs = self.get_gvs(1440, 300)
+        self.backfills += 1
 
         if gvs is None:
             self.logger.warning("No data received")
@@ -104,7 +145,7 @@ class DexcomShareSession():
         self.gvs = gvs
 
     def login(self):
-        url = "https://%s/ShareWebServices/Services/General/LoginPublisherAccountByName" % self.address
+        url = "%s/ShareWebServices/Services/General/LoginPublisherAccountByName" % self.base_url
         headers = {"Accept": "application/json",
                    "Content-Type": "application/json",
                    "User-Agent": "Dexcom Share/3.0.2.11 CFNetwork/711.2.23 Darwin/14.0.0"}
@@ -114,8 +155,11 @@ class DexcomShareSession():
 
         self.logger.debug("Attempting to login")
         result = None
+        self.logins += 1
         try:
-            result = self.session.post(url, data=json.dumps(payload), headers=headers)
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            result = self.session.post(url, data=json.dumps(payload), headers=headers, timeout=self.request_timeout)
         except Exception as e:
             self.logger.error(e)
 
@@ -127,6 +171,8 @@ class DexcomShareSession():
             self.logger.info("Login successful, session id: %s" % self.dexcom_session_id)
 
     def recreate_session(self):
+        if self.http_session is not None:
+            return
         try:
             self.session.close()
         except Exception as ex:
@@ -134,15 +180,18 @@ class DexcomShareSession():
         self.session = requests.Session()
 
     def get_gvs(self, minutes, maxCount):
-        url = "https://%s/ShareWebServices/Services/Publisher/ReadPublisherLatestGlucoseValues" % self.address
+        url = "%s/ShareWebServices/Services/Publisher/ReadPublisherLatestGlucoseValues" % self.base_url
         url += "?sessionId=%s&minutes=%d&maxCount=%d" % (self.dexcom_session_id, minutes, maxCount)
         headers = {"Accept": "application/json",
                    "User-Agent": "Dexcom Share/3.0.2.11 CFNetwork/711.2.23 Darwin/14.0.0"}
         result = None
+        self.requests += 1
         try:
-            result = self.session.post(url, headers=headers)
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            result = self.session.post(url, headers=headers, timeout=self.request_timeout)
         except Exception as ex:
-            self.logger.error(exc_info=ex)
+            self.logger.error("Error requesting glucose values", exc_info=ex)
 
         gvs = []
         if result is not None and result.status_code == 200:
@@ -150,11 +199,150 @@ class DexcomShareSession():
                 gvs.append(GlucoseValue.from_json(jsonResult))
             return gvs
         else:
+            if result is not None and self.session_expired(result):
+                self.logger.info("Dexcom share session expired")
+                self.dexcom_session_id = None
             self.recreate_session()
             return None
 
+    @staticmethod
+    def session_expired(result):
+        try:
+            return result.json().get("Code") in ("SessionIdNotFound", "SessionNotValid")
+        except Exception:
+            return False
+
     def get_last_gv(self):
         r = self.get_gvs(1440, 1)
         if r is not None and len(r) > 0:
             return r[0]
         return None
+
+
+class RateLimiter:
+    # token bucket shared by all accounts polling the same share server
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst) if burst else max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.ts_last = time.monotonic()
+        self.lock = threading.Lock()
+        self.waits = 0
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                ts_now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (ts_now - self.ts_last) * self.rate)
+                self.ts_last = ts_now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+                self.waits += 1
+            time.sleep(wait)
+
+
+class ShareScheduler:
+    # Polls many share accounts from a single heap of due times. One thread waits
+    # for the next due account and hands it to a fixed pool of workers, so the
+    # number of threads and http connections does not grow with the accounts.
+    # Each account is in the heap at most once, it is put back with the wait
+    # returned by its perform_request once that has finished.
+    def __init__(self, workers=4, rate=5.0, request_timeout=30):
+        self.logger = logging.getLogger('DEXPY')
+        self.workers = workers
+        self.rate_limiter = RateLimiter(rate) if rate else None
+        self.request_timeout = request_timeout
+        self.http_session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=workers)
+        self.http_session.mount("https://", adapter)
+        self.http_session.mount("http://", adapter)
+        self.sessions = []
+        self.heap = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.stopping = False
+        self.thread = None
+        self.executor = None
+
+    def add(self, location, username, password, callback, base_url=None, name=None):
+        session = DexcomShareSession(location, username, password, callback, base_url, name=name,
+                                     http_session=self.http_session, rate_limiter=self.rate_limiter,
+                                     request_timeout=self.request_timeout)
+        self.sessions.append(session)
+        return session
+
+    def open(self):
+        self.stopping = False
+        for session in self.sessions:
+            session.open()
+            self.schedule(session, 0)
+
+    def close(self):
+        with self.condition:
+            self.heap = []
+        for session in self.sessions:
+            session.close()
+        self.http_session.close()
+
+    def schedule(self, session, wait):
+        with self.condition:
+            heapq.heappush(self.heap, (time.time() + wait, next(self.sequence), session))
+            self.condition.notify()
+
+    def pop_due(self, ts_now):
+        due = []
+        with self.condition:
+            while len(self.heap) > 0 and self.heap[0][0] <= ts_now:
+                due.append(heapq.heappop(self.heap)[2])
+        return due
+
+    def next_due(self):
+        with self.condition:
+            return self.heap[0][0] if len(self.heap) > 0 else None
+
+    def poll(self, session):
+        try:
+            return session.perform_request()
+        except Exception as ex:
+            self.logger.error("Error polling dexcom share server for %s" % session.name, exc_info=ex)
+            return 60
+
+    def start_monitoring(self):
+        self.open()
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="share")
+        self.thread = threading.Thread(target=self.run, name="share-scheduler")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop_monitoring(self):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+        self.close()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.stopping:
+                    ts_next = self.next_due()
+                    timeout = None if ts_next is None else ts_next - time.time()
+                    if timeout is not None and timeout <= 0:
+                        break
+                    self.condition.wait(timeout)
+                if self.stopping:
+                    return
+                due = self.pop_due(time.time())
+            for session in due:
+                self.executor.submit(self.poll_and_schedule, session)
+
+    def poll_and_schedule(self, session):
+        wait = self.poll(session)
+        if not self.stopping:
+            self.logger.debug("next request for %s in %d seconds" % (session.name, wait))
+            self.schedule(session, wait)
@@ -0,0 +1,324 @@
+import argparse
+import json
+import logging
+import math
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# Local stand-in for the two Dexcom Share endpoints dexpy uses. It serves a
+# generated 5 minute series per account or replays recorded responses, and can
+# expire sessions, fail requests and answer slowly.
+#
+#   python dexcom_share_standin.py --port 8080
+#   python dexpy.py --DEXCOM-SHARE-URL http://localhost:8080 ...
+#   python dexcom_share_standin.py --load 50 --duration 900
+
+LOGIN_PATH = "/ShareWebServices/Services/General/LoginPublisherAccountByName"
+READ_PATH = "/ShareWebServices/Services/Publisher/ReadPublisherLatestGlucoseValues"
+INTERVAL = 300
+
+
+def share_date(ts):
+    return "/Date(%d)/" % int(ts * 1000)
+
+
+def share_value(st, value, trend):
+    return {"WT": share_date(st), "ST": share_date(st), "DT": share_date(st)[:-2] + "+0000)/",
+            "Value": value, "Trend": trend}
+
+
+def _as_ts(val):
+    return int(val[6:val.index(")")].split("+")[0].split("-")[0]) / 1000
+
+
+class GeneratedSeries:
+    # one reading every interval seconds, values follow a slow sine plus noise
+    # derived from the reading's slot so every request sees the same history
+    def __init__(self, seed, interval=INTERVAL, delay=30):
+        rnd = random.Random(seed)
+        self.seed = seed
+        self.interval = interval
+        self.phase = rnd.uniform(0, interval)
+        self.delay = delay
+
+    def readings(self, ts_now, minutes, max_count):
+        # newest first, as the share server returns them
+        last = math.floor((ts_now - self.delay - self.phase) / self.interval)
+        first = math.floor((ts_now - minutes * 60 - self.phase) / self.interval) + 1
+        result = []
+        for slot in range(last, max(first, last - max_count + 1) - 1, -1):
+            rnd = random.Random("%s:%d" % (self.seed, slot))
+            value = int(140 + 50 * math.sin(slot / 24.0) + rnd.uniform(-4, 4))
+            delta = 50 * (math.sin(slot / 24.0) - math.sin((slot - 1) / 24.0))
+            trend = 4 - max(-3, min(3, int(round(delta / 2.5))))
+            result.append(share_value(slot * self.interval + self.phase, value, trend))
+        return result
+
+
+class ReplaySeries:
+    # recorded readings moved in time so that the first history seconds of the
+    # recording are already in the past when the server starts
+    def __init__(self, recorded, history=24 * 60 * 60):
+        recorded = sorted(recorded, key=lambda r: _as_ts(r["ST"]))
+        self.recorded = recorded
+        self.times = [_as_ts(r["ST"]) for r in recorded]
+        self.shift = 0.0
+        if len(self.times) > 0:
+            self.shift = time.time() - self.times[0] - history
+
+    @staticmethod
+    def load(path, history=24 * 60 * 60):
+        # a json list of readings or one recorded response per line
+        with open(path) as f:
+            text = f.read()
+        try:
+            recorded = json.loads(text)
+        except ValueError:
+            recorded = []
+            for line in text.splitlines():
+                if line.strip():
+                    recorded.extend(json.loads(line))
+        unique = dict((r["ST"], r) for r in recorded)
+        return ReplaySeries(list(unique.values()), history)
+
+    def readings(self, ts_now, minutes, max_count):
+        ts_from = ts_now - minutes * 60
+        result = []
+        for ts, reading in zip(reversed(self.times), reversed(self.recorded)):
+            st = ts + self.shift
+            if st > ts_now:
+                continue
+            if st <= ts_from or len(result) >= max_count:
+                break
+            result.append(share_value(st, reading["Value"], reading["Trend"]))
+        return result
+
+
+class ShareStandIn:
+    def __init__(self, host="127.0.0.1", port=0, password=None, replay=None, session_ttl=None,
+                 error_rate=0.0, slow_rate=0.0, slow_seconds=5.0, seed=None):
+        self.logger = logging.getLogger('DEXPY')
+        self.password = password
+        self.replay = replay
+        self.session_ttl = session_ttl
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_seconds = slow_seconds
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.series = {}
+        self.stats = {"logins": 0, "reads": 0, "values": 0, "errors": 0, "expired": 0, "slow": 0}
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return "http://%s:%d" % (host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="share-standin")
+        self.thread.daemon = True
+        self.thread.start()
+        return self.url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.stats[key] += n
+
+    def series_for(self, account):
+        with self.lock:
+            series = self.series.get(account)
+            if series is None:
+                series = self.replay if self.replay is not None else GeneratedSeries(account)
+                self.series[account] = series
+            return series
+
+    def login(self, body):
+        self.count("logins")
+        account = body.get("accountName")
+        if not account or (self.password is not None and body.get("password") != self.password):
+            return 500, {"Code": "AccountPasswordInvalid", "Message": "Publisher account password failed"}
+        session_id = str(uuid.uuid4())
+        with self.lock:
+            self.sessions[session_id] = (account, time.time())
+        return 200, session_id
+
+    def read(self, query):
+        self.count("reads")
+        session_id = query.get("sessionId", [""])[0]
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is not None and self.session_ttl is not None \
+                    and time.time() - session[1] > self.session_ttl:
+                del self.sessions[session_id]
+                self.stats["expired"] += 1
+                session = None
+        if session is None:
+            return 500, {"Code": "SessionIdNotFound", "Message": "Session ID %s not found" % session_id}
+        try:
+            minutes = int(query.get("minutes", ["1440"])[0])
+            max_count = int(query.get("maxCount", ["1"])[0])
+        except ValueError:
+            return 400, {"Code": "InvalidArgument"}
+        readings = self.series_for(session[0]).readings(time.time(), minutes, max_count)
+        self.count("values", len(readings))
+        return 200, readings
+
+    def _handler(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                length = int(self.headers.get("Content-Length") or 0)
+                raw = self.rfile.read(length) if length > 0 else b""
+
+                if standin.slow_rate and standin.random.random() < standin.slow_rate:
+                    standin.count("slow")
+                    time.sleep(standin.slow_seconds)
+                if standin.error_rate and standin.random.random() < standin.error_rate:
+                    standin.count("errors")
+                    self.respond(500, {"Code": "InternalServerError", "Message": "injected failure"})
+                    return
+
+                if url.path == LOGIN_PATH:
+                    try:
+                        body = json.loads(raw.decode("utf-8") or "{}")
+                    except ValueError:
+                        body = {}
+                    self.respond(*standin.login(body))
+                elif url.path == READ_PATH:
+                    self.respond(*standin.read(parse_qs(url.query)))
+                else:
+                    self.respond(404, {"Code": "NotFound"})
+
+            def do_GET(self):
+                if urlparse(self.path).path == "/stats":
+                    with standin.lock:
+                        self.respond(200, dict(standin.stats, sessions=len(standin.sessions)))
+                else:
+                    self.respond(404, {"Code": "NotFound"})
+
+            def respond(self, status, body):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, fmt, *args):
+                standin.logger.debug("share stand-in: " + fmt % args)
+
+        return Handler
+
+
+def run_load(url, accounts, duration, timers=False):
+    # polls the stand-in with one DexcomShareSession per account, driven by a
+    # ShareScheduler or by each session's own timers, and reports requests,
+    # logins, backfills, client cpu time per account and the peak thread count
+    from dexcom_share import DexcomShareSession, ShareScheduler
+
+    received = [0]
+    lock = threading.Lock()
+
+    def callback(gvs):
+        with lock:
+            received[0] += len(gvs)
+
+    scheduler = None
+    if timers:
+        sessions = [DexcomShareSession(None, "account%d" % i, "password", callback, base_url=url)
+                    for i in range(accounts)]
+    else:
+        scheduler = ShareScheduler(rate=0)
+        sessions = [scheduler.add(None, "account%d" % i, "password", callback, base_url=url, name="account%d" % i)
+                    for i in range(accounts)]
+    cpu_start = time.process_time()
+    ts_start = time.time()
+    if scheduler is not None:
+        scheduler.start_monitoring()
+    else:
+        for session in sessions:
+            session.start_monitoring()
+    threads = threading.active_count()
+    ts_end = ts_start + duration
+    while time.time() < ts_end:
+        time.sleep(min(1.0, max(0.0, ts_end - time.time())))
+        threads = max(threads, threading.active_count())
+    if scheduler is not None:
+        scheduler.stop_monitoring()
+    else:
+        for session in sessions:
+            session.stop_monitoring()
+    cpu = time.process_time() - cpu_start
+    elapsed = time.time() - ts_start
+    return {
+        "accounts": accounts,
+        "seconds": round(elapsed, 1),
+        "values_received": received[0],
+        "requests_per_account": sum(s.requests for s in sessions) / accounts,
+        "logins_per_account": sum(s.logins for s in sessions) / accounts,
+        "backfills_per_account": sum(s.backfills for s in sessions) / accounts,
+        "cpu_seconds_per_account": round(cpu / accounts, 5),
+        "cpu_seconds_per_account_hour": round(cpu / accounts / elapsed * 3600, 5),
+        "peak_threads": threads,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Dexcom Share stand-in server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--password", default=None, help="only accept this password")
+    parser.add_argument("--replay", default=None, help="recorded readings to serve instead of generated ones")
+    parser.add_argument("--replay-history-hours", type=float, default=24)
+    parser.add_argument("--session-ttl", type=float, default=None, help="seconds until a session expires")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--slow-rate", type=float, default=0.0)
+    parser.add_argument("--slow-seconds", type=float, default=5.0)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--load", type=int, default=0, help="poll the stand-in with this many accounts")
+    parser.add_argument("--duration", type=float, default=900)
+    parser.add_argument("--timers", action="store_true", help="poll with a timer per account instead of a scheduler")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    replay = None
+    if args.replay is not None:
+        replay = ReplaySeries.load(args.replay, args.replay_history_hours * 3600)
+    standin = ShareStandIn(args.host, 0 if args.load else args.port, args.password, replay, args.session_ttl,
+                           args.error_rate, args.slow_rate, args.slow_seconds, args.seed)
+    url = standin.start()
+    try:
+        if args.load:
+            # the stand-in runs in this process too, its cpu time is included
+            logging.getLogger('DEXPY').setLevel(logging.WARNING)
+            result = run_load(url, args.load, args.duration, args.timers)
+            result["server"] = standin.stats
+            print(json.dumps(result, indent=2))
+        else:
+            logging.getLogger('DEXPY').info("dexcom share stand-in listening on %s" % url)
+            while True:
+                time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        standin.stop()
+
+
+if __name__ == "__main__":
+    main()
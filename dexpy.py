@@ -1,25 +1,52 @@
 #!/usr/bin/python3
 import argparse
-import bisect
-import datetime as dt
+import gzip
 import logging
 import signal
-import sqlite3
 import ssl
 import threading
+import time
 from queue import Queue, Empty
 
 import paho.mqtt.client as mqttc
 import requests
 import simplejson as json
-from influxdb import InfluxDBClient
 from paho.mqtt.client import MQTTv311
 
 from dexcom_receiver import DexcomReceiverSession
-from dexcom_share import DexcomShareSession
+from dexcom_share import DexcomShareSession, ShareScheduler
+from glucose import GlucoseIndex, GlucoseRing
+from glucose_store import GlucoseStore
+from influx_writer import InfluxLineWriter
+from sink_worker import SinkWorker
+from async_runtime import AsyncRuntime, AsyncSinkWorker
+from metrics import MetricsServer
 import os
 import distro
 
+OUTBOX_RETRY_INTERVAL = 60
+MQTT_MAX_INFLIGHT = 100
+# values kept for deduplication per share account, a day of readings with room for late backfills
+ACCOUNT_RING_SIZE = 1024
+
+
+def parse_share_accounts(value):
+    # a list of account objects, or its json text when given on the command line
+    if value is None or value == "":
+        return []
+    if isinstance(value, str):
+        value = json.loads(value)
+    accounts = []
+    for account in value:
+        if not account.get("username"):
+            raise ValueError("dexcom share account without username")
+        name = account.get("name") or account["username"]
+        if name in [a["name"] for a in accounts]:
+            raise ValueError("duplicate dexcom share account %s" % name)
+        accounts.append(dict(account, name=name))
+    return accounts
+
+
 class DexPy:
     def __init__(self, args):
         self.logger = logging.getLogger('DEXPY')
@@ -28,6 +55,7 @@ class DexPy:
         self.exit_event = threading.Event()
         self.message_published_event = threading.Event()
 
+        self.store = GlucoseStore(self.args.DB_PATH, self.args.DB_RETENTION_DAYS)
         self.initialize_db()
         self.mqtt_client = None
         if args.MQTT_SERVER is not None:
@@ -45,53 +73,146 @@ class DexPy:
             self.mqtt_client.on_message = self.on_mqtt_message_receive
             self.mqtt_client.on_publish = self.on_mqtt_message_publish
 
-        self.influx_client = None
+        self.influx_writer = None
+        self.ts_influx_flush = None
         if self.args.INFLUXDB_SERVER is not None:
-            self.influx_client = InfluxDBClient(self.args.INFLUXDB_SERVER, self.args.INFLUXDB_PORT, self.args.INFLUXDB_USERNAME,
-                                                self.args.INFLUXDB_PASSWORD, self.args.INFLUXDB_DATABASE,
-                                                ssl=self.args.INFLUXDB_SSL, verify_ssl=self.args.INFLUXDB_SSL_VERIFY)
+            self.influx_writer = InfluxLineWriter(self.args.INFLUXDB_SERVER, self.args.INFLUXDB_PORT,
+                                                  self.args.INFLUXDB_USERNAME, self.args.INFLUXDB_PASSWORD,
+                                                  self.args.INFLUXDB_DATABASE, self.args.INFLUXDB_MEASUREMENT,
+                                                  ssl=str(self.args.INFLUXDB_SSL).lower() == "true",
+                                                  verify_ssl=str(self.args.INFLUXDB_SSL_VERIFY).lower() == "true",
+                                                  use_gzip=str(self.args.INFLUXDB_GZIP).lower() == "true",
+                                                  batch_size=int(self.args.INFLUXDB_BATCH_SIZE),
+                                                  flush_interval_ms=float(self.args.INFLUXDB_FLUSH_INTERVAL_MS))
 
         self.callback_queue = Queue()
-        self.glucose_values = []
+        self.glucose_values = GlucoseRing(4096)
+        self.glucose_index = GlucoseIndex()
+        # account -> (ring, index) of recent values, None is the default source
+        self.histories = {None: (self.glucose_values, self.glucose_index)}
+        self.share_accounts = {}
+        for account in parse_share_accounts(self.args.DEXCOM_SHARE_ACCOUNTS):
+            self.share_accounts[account["name"]] = account
+            self.histories[account["name"]] = (GlucoseRing(ACCOUNT_RING_SIZE), GlucoseIndex())
+        # account -> new values whose write to the local db failed, tried again with the next batch
+        self.unwritten = {}
+        self.values_received = 0
+        self.values_duplicate = 0
+        ts_since = time.time() - 24 * 60 * 60
+        for account in self.histories:
+            for gv in self.store.read_since(ts_since, account):
+                self.add_glucose_value(gv, account)
+
+        worker_class = SinkWorker
+        if str(self.args.RUNTIME).lower() == "asyncio":
+            worker_class = AsyncSinkWorker
+        self.sink_workers = {}
+        if self.mqtt_client is not None:
+            self.sink_workers["mqtt"] = worker_class("mqtt", self.drain_mqtt, self.store,
+                                                     int(self.args.SINK_QUEUE_SIZE), self.args.MQTT_BACKPRESSURE,
+                                                     OUTBOX_RETRY_INTERVAL)
+        if self.influx_writer is not None:
+            self.sink_workers["influx"] = worker_class("influx", self.drain_influx, self.store,
+                                                       int(self.args.SINK_QUEUE_SIZE), self.args.INFLUXDB_BACKPRESSURE,
+                                                       OUTBOX_RETRY_INTERVAL)
+        if self.args.NIGHTSCOUT_URL is not None:
+            self.sink_workers["ns"] = worker_class("ns", self.drain_ns, self.store,
+                                                   int(self.args.SINK_QUEUE_SIZE), self.args.NIGHTSCOUT_BACKPRESSURE,
+                                                   OUTBOX_RETRY_INTERVAL)
+
+        # message id -> outbox row id and publish time of mqtt messages waiting to be acknowledged
         self.mqtt_pending = {}
-        self.influx_pending = []
-        self.ns_pending = []
+        self.mqtt_early_acks = set()
+        self.mqtt_pending_lock = threading.Lock()
+        self.mqtt_lock = threading.RLock()
+        self.mqtt_connected = False
+        self.mqtt_last_id = 0
 
         self.ns_session = None
         if self.args.NIGHTSCOUT_URL is not None:
             self.ns_session = requests.Session()
 
+        # sinks, mqtt topic and influx line prefix of each share account
+        self.account_sinks = {None: list(self.sink_workers.keys())}
+        self.mqtt_topics = {None: self.args.MQTT_TOPIC}
+        self.influx_prefixes = {None: None}
+        for name, account in self.share_accounts.items():
+            self.account_sinks[name] = [sink for sink in self.sink_workers.keys()
+                                        if sink != "ns" or str(account.get("nightscout")).lower() == "true"]
+            self.mqtt_topics[name] = account.get("mqtt_topic") or "%s/%s" % (self.args.MQTT_TOPIC, name)
+            if self.influx_writer is not None:
+                tags = account.get("influxdb_tags") or {"account": name}
+                self.influx_prefixes[name] = self.influx_writer.prefix_for(
+                    account.get("influxdb_measurement") or self.influx_writer.measurement, tags)
+
+        # values of accounts no longer configured have no route, they must not go to the default one
+        for name, count in self.store.outbox_discard_accounts(self.share_accounts.keys()).items():
+            self.logger.warning("Dropped %d undelivered outbox entries of dexcom share account %s which is no longer "
+                                "configured" % (count, name))
+
         self.dexcom_share_session = None
-        if self.args.DEXCOM_SHARE_SERVER is not None:
+        # with share accounts configured, the server settings alone are their defaults
+        if (self.args.DEXCOM_SHARE_SERVER is not None or self.args.DEXCOM_SHARE_URL is not None) \
+                and (len(self.share_accounts) == 0 or self.args.DEXCOM_SHARE_USERNAME):
             self.logger.info("starting dexcom share session")
             self.dexcom_share_session = DexcomShareSession(self.args.DEXCOM_SHARE_SERVER,
                                                            self.args.DEXCOM_SHARE_USERNAME,
                                                            self.args.DEXCOM_SHARE_PASSWORD,
-                                                           self.glucose_values_received)
+                                                           self.glucose_values_received,
+                                                           self.args.DEXCOM_SHARE_URL)
+
+        self.share_scheduler = None
+        if len(self.share_accounts) > 0:
+            self.logger.info("starting %d dexcom share account sessions" % len(self.share_accounts))
+            self.share_scheduler = ShareScheduler(int(self.args.DEXCOM_SHARE_WORKERS),
+                                                  float(self.args.DEXCOM_SHARE_RATE_LIMIT or 0))
+            for name, account in self.share_accounts.items():
+                self.share_scheduler.add(account.get("server") or self.args.DEXCOM_SHARE_SERVER,
+                                         account["username"], account.get("password", ""),
+                                         self.account_callback(name),
+                                         account.get("url") or self.args.DEXCOM_SHARE_URL, name)
 
         self.dexcom_receiver_session = None
         if self.args.USB_RECEIVER is not None and self.args.USB_RECEIVER:
-            self.dexcom_receiver_session = DexcomReceiverSession(self.glucose_values_received, self.args.USB_RESET_COMMAND)
+            self.dexcom_receiver_session = DexcomReceiverSession(self.glucose_values_received, self.args.USB_RESET_COMMAND,
+                                                                 int(self.args.USB_PAGE_CACHE_BYTES),
+                                                                 float(self.args.USB_TIMEOUT_MS) / 1000,
+                                                                 float(self.args.USB_PAGE_TIMEOUT_MS) / 1000,
+                                                                 int(self.args.USB_RETRIES),
+                                                                 self.args.USB_PORT)
+
+        self.metrics_server = None
+        if self.args.METRICS_PORT is not None:
+            self.metrics_server = MetricsServer(self, int(self.args.METRICS_PORT), self.args.METRICS_ADDRESS or "")
 
         for sig in ('HUP', 'INT'):
             signal.signal(getattr(signal, 'SIG' + sig), lambda _0, _1: self.exit_event.set())
 
     def run(self):
-        if self.mqtt_client is not None:
-            self.logger.info("starting mqtt service connection")
-            self.mqtt_client.reconnect_delay_set(min_delay=15, max_delay=120)
-            self.mqtt_client.connect_async(self.args.MQTT_SERVER, port=self.args.MQTT_PORT, keepalive=60)
-            self.mqtt_client.retry_first_connection = True
-            self.mqtt_client.loop_start()
+        if self.metrics_server is not None:
+            self.metrics_server.start()
+
+        if str(self.args.RUNTIME).lower() == "asyncio":
+            AsyncRuntime(self).run()
+            return
+
+        self.start_mqtt()
 
         if self.dexcom_share_session is not None:
             self.logger.info("starting monitoring dexcom share server")
             self.dexcom_share_session.start_monitoring()
 
+        if self.share_scheduler is not None:
+            self.logger.info("starting monitoring dexcom share accounts")
+            self.share_scheduler.start_monitoring()
+
         if self.dexcom_receiver_session is not None:
             self.logger.info("starting usb receiver service")
             self.dexcom_receiver_session.start_monitoring()
 
+        for worker in self.sink_workers.values():
+            worker.start()
+
         queue_thread = threading.Thread(target=self.queue_handler)
         queue_thread.start()
 
@@ -99,9 +220,8 @@ class DexPy:
             while not self.exit_event.wait(timeout=1000):
                 pass
         except KeyboardInterrupt:
-            pass
+            self.exit_event.set()
 
-        self.exit_event.clear()
         if self.dexcom_receiver_session is not None:
             self.logger.info("stopping dexcom receiver service")
             self.dexcom_receiver_session.stop_monitoring()
@@ -110,162 +230,298 @@ class DexPy:
             self.logger.info("stopping listening on dexcom share server")
             self.dexcom_share_session.stop_monitoring()
 
+        if self.share_scheduler is not None:
+            self.logger.info("stopping dexcom share accounts")
+            self.share_scheduler.stop_monitoring()
+
+        self.logger.info("processing remaining values")
+        queue_thread.join()
+
+        for name, worker in self.sink_workers.items():
+            self.logger.info("stopping %s sink worker" % name)
+            worker.stop()
+
+        self.close_clients()
+
+    def start_mqtt(self):
+        if self.mqtt_client is not None:
+            self.logger.info("starting mqtt service connection")
+            self.mqtt_client.reconnect_delay_set(min_delay=15, max_delay=120)
+            self.mqtt_client.connect_async(self.args.MQTT_SERVER, port=int(self.args.MQTT_PORT), keepalive=60)
+            self.mqtt_client.retry_first_connection = True
+            self.mqtt_client.loop_start()
+
+    def close_clients(self):
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+
         if self.mqtt_client is not None:
             self.logger.info("stopping mqtt client")
             self.mqtt_client.loop_stop()
             self.mqtt_client.disconnect()
 
-        if self.influx_client is not None:
+        if self.influx_writer is not None:
             self.logger.info("closing influxdb client")
-            self.influx_client.close()
+            self.influx_writer.close()
 
         if self.ns_session is not None:
             self.logger.info("closing nightscout session")
             self.ns_session.close()
 
+        self.logger.info("closing local db")
+        self.store.close()
+
     def on_mqtt_connect(self, client, userdata, flags, rc):
         self.logger.info("Connected to mqtt server with result code " + str(rc))
-        self.logger.debug("Pending %d messages in local queue" % len(self.mqtt_pending))
+        self.logger.debug("Pending %d messages in local queue" % self.store.outbox_count("mqtt"))
+        self.mqtt_connected = rc == 0
+        if self.mqtt_connected:
+            self.try_drain_mqtt()
 
     def on_mqtt_disconnect(self, client, userdata, rc):
         self.logger.info("Disconnected from mqtt with result code " + str(rc))
-        self.logger.debug("Pending %d messages in local queue" % len(self.mqtt_pending))
+        self.mqtt_connected = False
+        self.logger.debug("Pending %d messages in local queue" % self.store.outbox_count("mqtt"))
 
     def on_mqtt_message_receive(self, client, userdata, msg):
         self.logger.info("mqtt message received: " + msg)
 
     def on_mqtt_message_publish(self, client, userdata, msg_id):
         self.logger.info("mqtt message published: " + str(msg_id))
-        if msg_id in self.mqtt_pending:
-            self.mqtt_pending.pop(msg_id)
-        else:
-            self.logger.debug("unknown message id: " + str(msg_id))
-        self.logger.debug("Pending %d messages in local queue" % len(self.mqtt_pending))
-
-    def glucose_values_received(self, gvs):
-        for gv in gvs:
-            self.callback_queue.put(gv)
+        with self.mqtt_pending_lock:
+            pending = self.mqtt_pending.pop(msg_id, None)
+            if pending is None:
+                # acknowledged before drain_mqtt got to record the message id
+                self.mqtt_early_acks.add(msg_id)
+        if pending is not None:
+            row_id, ts_publish = pending
+            self.sink_workers["mqtt"].request_latency.observe(time.time() - ts_publish)
+            self.store.outbox_remove([row_id])
+        self.logger.debug("Pending %d messages in local queue" % self.store.outbox_count("mqtt"))
+        self.try_drain_mqtt()
+
+    def glucose_values_received(self, gvs, account=None):
+        self.callback_queue.put((account, gvs))
+
+    def account_callback(self, account):
+        return lambda gvs: self.glucose_values_received(gvs, account)
 
     def queue_handler(self):
-        while not self.exit_event.wait(timeout=0.200):
-            gvs = []
-            while True:
+        max_delay = float(self.args.BATCH_MAX_DELAY_MS) / 1000
+        max_size = int(self.args.BATCH_MAX_SIZE)
+        while True:
+            try:
+                account, gvs = self.callback_queue.get(block=True, timeout=0.5)
+            except Empty:
+                if self.exit_event.is_set():
+                    return
+                continue
+
+            # a live value goes out after at most max_delay, while
+            # values arriving together with it are processed as one batch
+            batches = {account: list(gvs)}
+            count = len(gvs)
+            ts_deadline = time.time() + max_delay
+            while count < max_size:
                 try:
-                    gv = self.callback_queue.get(block=True, timeout=5)
-                    gvs.append(gv)
+                    account, gvs = self.callback_queue.get(block=True, timeout=max(0.0, ts_deadline - time.time()))
                 except Empty:
-                    if len(gvs) > 0:
-                        self.process_glucose_values(gvs)
-                        gvs = []
-
-    def process_glucose_values(self, gvs):
-        new_values = []
-        for gv in gvs:
-            new_val = True
-            for gv_check in self.glucose_values:
-                if gv_check == gv:
-                    new_val = False
                     break
-            if new_val:
-                new_values.append(gv)
-                self.logger.info(f"New gv: {gv}")
+                batches.setdefault(account, []).extend(gvs)
+                count += len(gvs)
+            self.process_batches(batches)
+
+    def process_batches(self, batches):
+        for account, gvs in batches.items():
+            self.process_glucose_values(gvs, account)
+
+    def process_glucose_values(self, gvs, account=None):
+        glucose_index = self.histories[account][1]
+        # values only become known once they are in the outbox, until then a
+        # failed write is tried again instead of the values being lost as duplicates
+        new_values = self.unwritten.pop(account, [])
+        batch_index = GlucoseIndex()
+        for gv in new_values:
+            batch_index.add(gv)
+        duplicates = 0
+        for gv in gvs:
+            if gv in glucose_index or gv in batch_index:
+                duplicates += 1
+                continue
+            batch_index.add(gv)
+            new_values.append(gv)
+            self.logger.info(f"New gv: {gv}")
+        self.values_received += len(gvs)
+        self.values_duplicate += duplicates
+        if len(new_values) == 0:
+            return
+
+        sinks = self.account_sinks[account]
+        try:
+            self.store.write(new_values, sinks, account)
+        except Exception as ex:
+            self.logger.error("Error writing %d values to local db, trying again with the next batch"
+                              % len(new_values), exc_info=ex)
+            self.unwritten[account] = new_values
+            return
 
-        if self.mqtt_client is not None:
-            for gv in new_values:
+        for gv in new_values:
+            self.add_glucose_value(gv, account)
+        for sink in sinks:
+            self.sink_workers[sink].notify(new_values)
+
+    def add_glucose_value(self, gv, account=None):
+        glucose_values, glucose_index = self.histories[account]
+        glucose_index.add(gv)
+        evicted = glucose_values.insert(gv)
+        if evicted is not None:
+            glucose_index.discard(evicted)
+
+    def try_drain_mqtt(self):
+        # called from paho callbacks which may hold paho's message lock,
+        # never wait here for a drain running in another thread
+        if self.mqtt_lock.acquire(blocking=False):
+            try:
+                self.drain_mqtt()
+            finally:
+                self.mqtt_lock.release()
+
+    def drain_mqtt(self):
+        with self.mqtt_lock:
+            if not self.mqtt_connected:
+                return
+            space = MQTT_MAX_INFLIGHT - len(self.mqtt_pending)
+            if space <= 0:
+                return
+            for row_id, gv, account in self.store.outbox_peek("mqtt", space, self.mqtt_last_id):
                 msg = "%d|%s|%s" % (gv.st, gv.trend, gv.value)
-                x, mid = self.mqtt_client.publish(self.args.MQTT_TOPIC, payload=msg, qos=1)
-                self.mqtt_pending[mid] = gv
+                ts_publish = time.time()
+                x, mid = self.mqtt_client.publish(self.mqtt_topics[account], payload=msg, qos=1)
+                self.mqtt_last_id = row_id
+                with self.mqtt_pending_lock:
+                    if mid in self.mqtt_early_acks:
+                        self.mqtt_early_acks.remove(mid)
+                        acked = True
+                    else:
+                        self.mqtt_pending[mid] = (row_id, ts_publish)
+                        acked = False
+                if acked:
+                    self.sink_workers["mqtt"].request_latency.observe(time.time() - ts_publish)
+                    self.store.outbox_remove([row_id])
                 self.logger.debug("publish to mqtt requested with message id: " + str(mid))
 
-        if self.influx_client is not None:
-            for gv in new_values:
-                point = {
-                    "measurement": self.args.INFLUXDB_MEASUREMENT,
-                    "tags": {"device": "dexcomg6", "source": "dexpy"},
-                    "time": dt.datetime.utcfromtimestamp(gv.st).strftime("%Y-%m-%dT%H:%M:%SZ"),
-                    "fields": {"cbg": float(gv.value), "direction": int(gv.trend)}
-                }
-                self.influx_pending.append(point)
+    def drain_influx(self):
+        writer = self.influx_writer
+        while True:
+            rows = self.store.outbox_peek("influx", writer.batch_size)
+            if len(rows) == 0:
+                self.ts_influx_flush = None
+                return None
+
+            # a partial batch waits up to the flush interval for more points
+            ts_now = time.time()
+            if len(rows) < writer.batch_size:
+                if self.ts_influx_flush is None:
+                    self.ts_influx_flush = ts_now + writer.flush_interval
+                if ts_now < self.ts_influx_flush:
+                    return self.ts_influx_flush
+
+            latency = self.sink_workers["influx"].request_latency
+            ts_request = time.time()
+            if not writer.write([writer.line(gv, self.influx_prefixes[account]) for row_id, gv, account in rows]):
+                latency.errors += 1
+                self.ts_influx_flush = ts_now + OUTBOX_RETRY_INTERVAL
+                return self.ts_influx_flush
+            latency.observe(time.time() - ts_request)
+            self.store.outbox_remove([row_id for row_id, gv, account in rows])
+            self.ts_influx_flush = None
+
+    def drain_ns(self):
+        apiUrl = self.args.NIGHTSCOUT_URL
+        if apiUrl[-1] != "/":
+            apiUrl += "/"
+        apiUrl += "api/v1/entries/"
+        headers = {"Content-Type": "application/json"}
+        if self.args.NIGHTSCOUT_SECRET:
+            headers["api-secret"] = self.args.NIGHTSCOUT_SECRET
+        if self.args.NIGHTSCOUT_TOKEN:
+            apiUrl += "?token=" + self.args.NIGHTSCOUT_TOKEN
+        use_gzip = str(self.args.NIGHTSCOUT_GZIP).lower() == "true"
+        if use_gzip:
+            headers["Content-Encoding"] = "gzip"
+
+        while True:
+            rows = self.store.outbox_peek("ns", int(self.args.NIGHTSCOUT_CHUNK_SIZE))
+            if len(rows) == 0:
+                return
+            payload = []
+            for row_id, gv, account in rows:
+                payload.append({"sgv": gv.value, "type": "sgv", "direction": gv.trend_string(),
+                                "date": int(round(gv.st * 1000))})
+            data = json.dumps(payload).encode("utf-8")
+            if use_gzip:
+                data = gzip.compress(data)
+
+            latency = self.sink_workers["ns"].request_latency
+            ts_request = time.time()
             try:
-                if self.influx_client.write_points(self.influx_pending):
-                    self.influx_pending = []
+                response = self.ns_session.post(apiUrl, headers=headers, data=data)
             except Exception as ex:
-                self.logger.error("Error writing to influxdb", exc_info=ex)
-
-        if self.ns_session is not None:
-            apiUrl = self.args.NIGHTSCOUT_URL
-            if apiUrl[-1] != "/":
-                apiUrl += "/"
-            apiUrl += "api/v1/entries/"
-            headers = {"Content-Type": "application/json"}
-            if self.args.NIGHTSCOUT_SECRET:
-                headers["api-secret"] = self.args.NIGHTSCOUT_SECRET
-            if self.args.NIGHTSCOUT_TOKEN:
-                apiUrl += "?token=" + self.args.NIGHTSCOUT_TOKEN
-
-            for gv in new_values:
-                payload = {"sgv": gv.value, "type": "sgv", "direction": gv.trend_string(), "date": gv.st * 1000}
-                self.ns_pending.append(json.dumps(payload))
-                posted_entries = []
-                for pendingEntry in self.ns_pending:
-                    try:
-                        response = self.ns_session.post(apiUrl, headers=headers, data=pendingEntry)
-                        if response is not None and response.status_code == 200:
-                            posted_entries.append(pendingEntry)
-                        else:
-                            self.logger.error(f"NS server returned invalid response {response}")
-                    except Exception as ex:
-                        self.logger.error("Error posting value to nightscout", ex)
-                for posted_entry in posted_entries:
-                    self.ns_pending.remove(posted_entry)
-
-        for gv in new_values:
-            i = bisect.bisect_right(self.glucose_values, gv)
-            self.glucose_values.insert(i + 1, gv)
-
-        if len(self.glucose_values) > 4096:
-            self.glucose_values = self.glucose_values[4096 - len(self.glucose_values):]
+                latency.errors += 1
+                self.logger.error("Error posting values to nightscout", exc_info=ex)
+                return
+            if response is None or response.status_code != 200:
+                latency.errors += 1
+                self.logger.error(f"NS server returned invalid response {response}")
+                return
+            latency.observe(time.time() - ts_request)
+
+            posted_ids = self.confirmed_ns_entries(response, rows, payload)
+            self.store.outbox_remove(posted_ids)
+            self.logger.debug("Posted %d of %d entries to nightscout" % (len(posted_ids), len(rows)))
+            if len(posted_ids) < len(rows):
+                return
+
+    def confirmed_ns_entries(self, response, rows, payload):
+        # nightscout answers with the stored entries, keep whatever is not among them
+        try:
+            stored = response.json()
+        except Exception:
+            stored = None
+        if not isinstance(stored, list):
+            return [row_id for row_id, gv, account in rows]
+        stored_dates = set()
+        for entry in stored:
+            if isinstance(entry, dict) and "date" in entry:
+                stored_dates.add(int(round(float(entry["date"]))))
+        return [row_id for (row_id, gv, account), entry in zip(rows, payload) if entry["date"] in stored_dates]
 
     def initialize_db(self):
         try:
-            with sqlite3.connect(self.args.DB_PATH) as conn:
-                sql = """ CREATE TABLE IF NOT EXISTS gv (
-                          ts REAL,
-                          gv REAL,
-                          trend TEXT
-                          ) """
-                conn.execute(sql)
-
-                sql = """ CREATE INDEX "idx_ts" ON "gv" ("ts");"""
-                try:
-                    conn.execute(sql)
-                except:
-                    self.logger.debug("Index creation skipped")
-
+            self.store.open()
         except Exception as ex:
-            self.logger.warning("Error initializing local db", exc_info=ex)
-
+            self.logger.warning("Error initializing local db, falling back to an in-memory db", exc_info=ex)
+            self.store.close()
+            self.store.db_path = ":memory:"
+            self.store.open()
 
-if __name__ == '__main__':
-    logger = logging.getLogger('DEXPY')
-    logger.setLevel(logging.DEBUG)
-    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-
-    ch = logging.StreamHandler()
-    ch.setLevel(logging.DEBUG)
-    ch.setFormatter(formatter)
-    logger.addHandler(ch)
 
+def build_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("--CONFIGURATION", required=False, default=None, nargs="?")
     parser.add_argument("--DEXCOM-SHARE-SERVER", required=False, default=None, nargs="?")
     parser.add_argument("--DEXCOM-SHARE-USERNAME", required=False, default="", nargs="?")
     parser.add_argument("--DEXCOM-SHARE-PASSWORD", required=False, default="", nargs="?")
+    parser.add_argument("--DEXCOM-SHARE-URL", required=False, default=None, nargs="?")
+    parser.add_argument("--DEXCOM-SHARE-ACCOUNTS", required=False, default=None, nargs="?")
+    parser.add_argument("--DEXCOM-SHARE-WORKERS", required=False, default=4, nargs="?")
+    parser.add_argument("--DEXCOM-SHARE-RATE-LIMIT", required=False, default=5, nargs="?")
     parser.add_argument("--MQTT-SERVER", required=False, default=None, nargs="?")
     parser.add_argument("--MQTT-PORT", required=False, default="1881", nargs="?")
     parser.add_argument("--MQTT-SSL", required=False, default="", nargs="?")
     parser.add_argument("--MQTT-CLIENTID", required=False, default="dexpy", nargs="?")
     parser.add_argument("--MQTT-TOPIC", required=False, default="cgm", nargs="?")
+    parser.add_argument("--MQTT-BACKPRESSURE", required=False, default="drop", nargs="?")
     parser.add_argument("--INFLUXDB-SERVER", required=False, default=None, nargs="?")
     parser.add_argument("--INFLUXDB-PORT", required=False, default="8086", nargs="?")
     parser.add_argument("--INFLUXDB-SSL", required=False, default=False, nargs="?")
@@ -274,14 +530,36 @@ if __name__ == '__main__':
     parser.add_argument("--INFLUXDB-PASSWORD", required=False, default="", nargs="?")
     parser.add_argument("--INFLUXDB-DATABASE", required=False, default="", nargs="?")
     parser.add_argument("--INFLUXDB-MEASUREMENT", required=False, default="", nargs="?")
+    parser.add_argument("--INFLUXDB-GZIP", required=False, default=True, nargs="?")
+    parser.add_argument("--INFLUXDB-BATCH-SIZE", required=False, default=5000, nargs="?")
+    parser.add_argument("--INFLUXDB-FLUSH-INTERVAL-MS", required=False, default=1000, nargs="?")
+    parser.add_argument("--INFLUXDB-BACKPRESSURE", required=False, default="drop", nargs="?")
     parser.add_argument("--NIGHTSCOUT-URL", required=False, default=None, nargs="?")
     parser.add_argument("--NIGHTSCOUT-SECRET", required=False, default=None, nargs="?")
     parser.add_argument("--NIGHTSCOUT-TOKEN", required=False, default=None, nargs="?")
+    parser.add_argument("--NIGHTSCOUT-CHUNK-SIZE", required=False, default=100, nargs="?")
+    parser.add_argument("--NIGHTSCOUT-GZIP", required=False, default=False, nargs="?")
+    parser.add_argument("--NIGHTSCOUT-BACKPRESSURE", required=False, default="drop", nargs="?")
+    parser.add_argument("--SINK-QUEUE-SIZE", required=False, default=16, nargs="?")
+    parser.add_argument("--RUNTIME", required=False, default="threads", nargs="?")
+    parser.add_argument("--BATCH-MAX-DELAY-MS", required=False, default=20, nargs="?")
+    parser.add_argument("--BATCH-MAX-SIZE", required=False, default=1000, nargs="?")
     parser.add_argument("--DB-PATH", required=False, default="dexpy.db", nargs="?")
+    parser.add_argument("--DB-RETENTION-DAYS", required=False, default=90, nargs="?")
     parser.add_argument("--USB-RECEIVER", required=False, default=True, nargs="?")
     parser.add_argument("--USB-RESET-COMMAND", required=False, default=None, nargs="?")
+    parser.add_argument("--USB-PORT", required=False, default=None, nargs="?")
+    parser.add_argument("--USB-PAGE-CACHE-BYTES", required=False, default=1048576, nargs="?")
+    parser.add_argument("--USB-TIMEOUT-MS", required=False, default=2000, nargs="?")
+    parser.add_argument("--USB-PAGE-TIMEOUT-MS", required=False, default=5000, nargs="?")
+    parser.add_argument("--USB-RETRIES", required=False, default=2, nargs="?")
+    parser.add_argument("--METRICS-PORT", required=False, default=None, nargs="?")
+    parser.add_argument("--METRICS-ADDRESS", required=False, default="", nargs="?")
+    return parser
 
-    args = parser.parse_args()
+
+def parse_args(argv=None):
+    args = build_parser().parse_args(argv)
 
     if args.CONFIGURATION is not None:
         with open(args.CONFIGURATION, 'r') as stream:
@@ -289,6 +567,18 @@ if __name__ == '__main__':
 
         for js_arg in js:
             args.__dict__[js_arg] = js[js_arg]
+    return args
+
+
+if __name__ == '__main__':
+    logger = logging.getLogger('DEXPY')
+    logger.setLevel(logging.DEBUG)
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.DEBUG)
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
 
-    dexpy = DexPy(args)
+    dexpy = DexPy(parse_args())
     dexpy.run()
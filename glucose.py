@@ -1,5 +1,8 @@
 import logging
 import re
+from array import array
+
+SLOT_SECONDS = 300
 
 NightscoutTrendStrings = ['None', 'DoubleUp', 'SingleUp', 'FortyFiveUp', 'Flat', 'FortyFiveDown', 'SingleDown', 'DoubleDown', 'NotComputable', 'OutOfRange']
 
@@ -67,4 +70,147 @@ class GlucoseValue():
         return True
 
     def __str__(self):
-        return "DT: %s WT: %s ST: %s Trend: %s Value: %f" % (self.dt, self.wt, self.st, self.trend_string(), self.value)
\ No newline at end of file
+        return "DT: %s WT: %s ST: %s Trend: %s Value: %f" % (self.dt, self.wt, self.st, self.trend_string(), self.value)
+
+
+class GlucoseIndex():
+    # values are bucketed by their 5 minute slot, a value within 240 seconds
+    # of another can only be in the same or in one of the neighbouring slots
+    def __init__(self):
+        self.slots = {}
+        self.count = 0
+
+    @staticmethod
+    def slot(st):
+        return int(st // SLOT_SECONDS)
+
+    def add(self, gv):
+        self.slots.setdefault(self.slot(gv.st), []).append((gv.st, int(round(gv.value))))
+        self.count += 1
+
+    def discard(self, gv):
+        slot = self.slot(gv.st)
+        entries = self.slots.get(slot)
+        if entries is None:
+            return
+        value = int(round(gv.value))
+        for i, entry in enumerate(entries):
+            if entry == (gv.st, value):
+                del entries[i]
+                self.count -= 1
+                break
+        if len(entries) == 0:
+            del self.slots[slot]
+
+    def __contains__(self, gv):
+        slot = self.slot(gv.st)
+        value = int(round(gv.value))
+        for s in (slot - 1, slot, slot + 1):
+            for st_check, value_check in self.slots.get(s, ()):
+                if value_check == value and abs(gv.st - st_check) < 240:
+                    return True
+        return False
+
+    def __len__(self):
+        return self.count
+
+
+class GlucoseRing():
+    # fixed capacity window of values ordered by st, stored in parallel columns
+    # with a moving head so appends and evictions never copy the whole buffer
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.st = array('d', bytes(8 * capacity))
+        self.value = array('d', bytes(8 * capacity))
+        self.trend = array('B', bytes(capacity))
+        self.head = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if i < 0 or i >= self.count:
+            raise IndexError("ring index out of range")
+        p = (self.head + i) % self.capacity
+        return GlucoseValue(None, None, self.st[p], self.value[p], self.trend[p])
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self[i]
+
+    def _st_at(self, i):
+        return self.st[(self.head + i) % self.capacity]
+
+    def bisect_left(self, st):
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._st_at(mid) < st:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def bisect_right(self, st):
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if st < self._st_at(mid):
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+
+    def between(self, st_from, st_to):
+        return [self[i] for i in range(self.bisect_left(st_from), self.bisect_right(st_to))]
+
+    def insert(self, gv):
+        # returns the value pushed out of the window, if any
+        evicted = None
+        i = self.bisect_right(gv.st)
+        if self.count == self.capacity:
+            if i == 0:
+                return gv
+            evicted = self[0]
+            self.head = (self.head + 1) % self.capacity
+            self.count -= 1
+            i -= 1
+
+        if i >= self.count - i:
+            self._move(i, i + 1, self.count - i)
+        else:
+            self._move(0, -1, i)
+            self.head = (self.head - 1) % self.capacity
+
+        p = (self.head + i) % self.capacity
+        self.st[p] = gv.st
+        self.value[p] = gv.value
+        self.trend[p] = gv.trend
+        self.count += 1
+        return evicted
+
+    def _move(self, src, dst, n):
+        # moves n entries between logical positions in physically contiguous runs
+        cap = self.capacity
+        columns = (self.st, self.value, self.trend)
+        if dst > src:
+            while n > 0:
+                s_end = (self.head + src + n - 1) % cap + 1
+                d_end = (self.head + dst + n - 1) % cap + 1
+                k = min(n, s_end, d_end)
+                for column in columns:
+                    column[d_end - k:d_end] = column[s_end - k:s_end]
+                n -= k
+        else:
+            while n > 0:
+                s = (self.head + src) % cap
+                d = (self.head + dst) % cap
+                k = min(n, cap - s, cap - d)
+                for column in columns:
+                    column[d:d + k] = column[s:s + k]
+                src += k
+                dst += k
+                n -= k
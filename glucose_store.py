@@ -0,0 +1,156 @@
+import logging
+import sqlite3
+import threading
+import time
+
+from glucose import GlucoseValue
+
+
+class GlucoseStore:
+    def __init__(self, db_path, retention_days=90):
+        self.logger = logging.getLogger('DEXPY')
+        self.db_path = db_path
+        self.retention_seconds = None
+        if retention_days is not None and float(retention_days) > 0:
+            self.retention_seconds = float(retention_days) * 24 * 60 * 60
+        self.lock = threading.RLock()
+        self.ts_next_prune = 0
+        self.conn = None
+
+    def open(self):
+        with self.lock:
+            # autocommit mode, transactions are managed explicitly per batch
+            self.conn = sqlite3.connect(self.db_path, isolation_level=None, check_same_thread=False)
+
+            # auto_vacuum can only be switched on an existing database by a full vacuum, done only once
+            if self.conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                self.conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                self.conn.execute("VACUUM")
+
+            self.conn.execute("PRAGMA journal_mode = WAL")
+            # in WAL mode this syncs the log once per committed transaction, not per row
+            self.conn.execute("PRAGMA synchronous = FULL")
+
+            sql = """ CREATE TABLE IF NOT EXISTS gv (
+                      ts REAL,
+                      gv REAL,
+                      trend TEXT,
+                      account TEXT
+                      ) """
+            self.conn.execute(sql)
+            self.conn.execute(""" CREATE INDEX IF NOT EXISTS "idx_ts" ON "gv" ("ts") """)
+
+            sql = """ CREATE TABLE IF NOT EXISTS outbox (
+                      id INTEGER PRIMARY KEY AUTOINCREMENT,
+                      sink TEXT,
+                      ts_queued REAL,
+                      ts REAL,
+                      gv REAL,
+                      trend INTEGER,
+                      account TEXT
+                      ) """
+            self.conn.execute(sql)
+            self.conn.execute(""" CREATE INDEX IF NOT EXISTS "idx_outbox_sink" ON "outbox" ("sink", "id") """)
+
+            # values of share accounts other than the default source, added to existing databases
+            for table in ("gv", "outbox"):
+                columns = [row[1] for row in self.conn.execute("PRAGMA table_info(%s)" % table)]
+                if "account" not in columns:
+                    self.conn.execute("ALTER TABLE %s ADD COLUMN account TEXT" % table)
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+    def write(self, gvs, sinks=(), account=None):
+        if self.conn is None or len(gvs) == 0:
+            return
+        rows = [(gv.st, gv.value, gv.trend, account) for gv in gvs]
+        ts_queued = time.time()
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.executemany("INSERT INTO gv (ts, gv, trend, account) VALUES (?, ?, ?, ?)", rows)
+                for sink in sinks:
+                    self.conn.executemany("INSERT INTO outbox (sink, ts_queued, ts, gv, trend, account) "
+                                          "VALUES (?, ?, ?, ?, ?, ?)",
+                                          [(sink, ts_queued) + row for row in rows])
+                self.conn.execute("COMMIT")
+            except:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.prune()
+
+    def read_since(self, ts_since, account=None):
+        if self.conn is None:
+            return []
+        with self.lock:
+            rows = self.conn.execute("SELECT ts, gv, trend FROM gv WHERE ts >= ? AND account IS ? ORDER BY ts",
+                                     (ts_since, account)).fetchall()
+        return [GlucoseValue(None, None, ts, value, int(trend)) for ts, value, trend in rows]
+
+    def outbox_peek(self, sink, limit, after_id=0):
+        # (row id, glucose value, account) of the oldest rows of the sink
+        if self.conn is None:
+            return []
+        with self.lock:
+            rows = self.conn.execute("SELECT id, ts, gv, trend, account FROM outbox WHERE sink = ? AND id > ? "
+                                     "ORDER BY id LIMIT ?", (sink, after_id, limit)).fetchall()
+        return [(row_id, GlucoseValue(None, None, ts, value, trend), account)
+                for row_id, ts, value, trend, account in rows]
+
+    def outbox_remove(self, ids):
+        if self.conn is None or len(ids) == 0:
+            return
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.executemany("DELETE FROM outbox WHERE id = ?", [(row_id,) for row_id in ids])
+                self.conn.execute("COMMIT")
+            except:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def outbox_discard_accounts(self, accounts):
+        # removes the rows of share accounts not among accounts, returns their number per account
+        if self.conn is None:
+            return {}
+        accounts = list(accounts)
+        condition = "account IS NOT NULL AND account NOT IN (%s)" % ", ".join("?" * len(accounts))
+        with self.lock:
+            counts = dict(self.conn.execute("SELECT account, COUNT(*) FROM outbox WHERE %s GROUP BY account"
+                                            % condition, accounts).fetchall())
+            if len(counts) > 0:
+                self.conn.execute("DELETE FROM outbox WHERE %s" % condition, accounts)
+        return counts
+
+    def outbox_count(self, sink):
+        if self.conn is None:
+            return 0
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM outbox WHERE sink = ?", (sink,)).fetchone()[0]
+
+    def outbox_oldest(self, sink):
+        if self.conn is None:
+            return None
+        with self.lock:
+            return self.conn.execute("SELECT MIN(ts_queued) FROM outbox WHERE sink = ?", (sink,)).fetchone()[0]
+
+    def prune(self, force=False):
+        if self.retention_seconds is None:
+            return
+        ts_now = time.time()
+        if not force and ts_now < self.ts_next_prune:
+            return
+        self.ts_next_prune = ts_now + 60 * 60
+        # best effort, the values written before are committed either way and are retried at the next prune
+        with self.lock:
+            try:
+                cursor = self.conn.execute("DELETE FROM gv WHERE ts < ?", (ts_now - self.retention_seconds,))
+                if cursor.rowcount > 0:
+                    self.logger.debug("Pruned %d rows from local db" % cursor.rowcount)
+                    self.conn.execute("PRAGMA incremental_vacuum")
+            except sqlite3.Error as ex:
+                self.logger.warning("Error pruning local db", exc_info=ex)
@@ -0,0 +1,60 @@
+import gzip
+import logging
+
+import requests
+
+
+def _escape_measurement(value):
+    return str(value).replace(",", "\\,").replace(" ", "\\ ")
+
+
+def _escape_tag(value):
+    return str(value).replace(",", "\\,").replace("=", "\\=").replace(" ", "\\ ")
+
+
+class InfluxLineWriter:
+    def __init__(self, server, port, username, password, database, measurement, ssl=False, verify_ssl=False,
+                 use_gzip=True, batch_size=5000, flush_interval_ms=1000):
+        self.logger = logging.getLogger('DEXPY')
+        self.url = "%s://%s:%s/write" % ("https" if ssl else "http", server, port)
+        self.params = {"db": database, "precision": "s"}
+        if username:
+            self.params["u"] = username
+            self.params["p"] = password
+        self.verify_ssl = verify_ssl
+        self.use_gzip = use_gzip
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.measurement = measurement
+        self.prefix = self.prefix_for(measurement)
+        self.session = requests.Session()
+
+    def prefix_for(self, measurement, tags=None):
+        all_tags = {"device": "dexcomg6", "source": "dexpy"}
+        if tags:
+            all_tags.update(tags)
+        return _escape_measurement(measurement) + "".join(",%s=%s" % (_escape_tag(k), _escape_tag(v))
+                                                          for k, v in sorted(all_tags.items())) + " "
+
+    def line(self, gv, prefix=None):
+        return "%scbg=%r,direction=%di %d" % (prefix or self.prefix, float(gv.value), int(gv.trend), int(gv.st))
+
+    def write(self, lines):
+        data = "\n".join(lines).encode("utf-8")
+        headers = {"Content-Type": "text/plain; charset=utf-8"}
+        if self.use_gzip:
+            data = gzip.compress(data)
+            headers["Content-Encoding"] = "gzip"
+        try:
+            response = self.session.post(self.url, params=self.params, data=data, headers=headers,
+                                         verify=self.verify_ssl)
+        except Exception as ex:
+            self.logger.error("Error writing to influxdb", exc_info=ex)
+            return False
+        if response.status_code != 204:
+            self.logger.error("InfluxDB returned invalid response %s: %s" % (response, response.text))
+            return False
+        return True
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,201 @@
+import logging
+import math
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Prometheus text exposition of dexpy's internal counters. Sources, the dispatcher
+# and sink workers only bump plain attributes and histograms as they go, the
+# values are collected when the endpoint is scraped.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _format_value(value):
+    if value is None:
+        return "NaN"
+    if isinstance(value, float):
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        if math.isnan(value):
+            return "NaN"
+        return repr(value)
+    return str(int(value))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                          for k, v in labels) + "}"
+
+
+class MetricsWriter:
+    # samples are grouped by metric family, as the format requires, in the order
+    # the families are first seen
+    def __init__(self):
+        self.families = {}
+
+    def _family(self, name, metric_type, help_text):
+        family = self.families.get(name)
+        if family is None:
+            family = ["# HELP %s %s" % (name, help_text), "# TYPE %s %s" % (name, metric_type)]
+            self.families[name] = family
+        return family
+
+    @staticmethod
+    def _sample(name, value, labels):
+        return "%s%s %s" % (name, _format_labels(labels), _format_value(value))
+
+    def gauge(self, name, help_text, value, labels=()):
+        self._family(name, "gauge", help_text).append(self._sample(name, value, labels))
+
+    def counter(self, name, help_text, value, labels=()):
+        self._family(name, "counter", help_text).append(self._sample(name, value, labels))
+
+    def histogram(self, name, help_text, histogram, labels=()):
+        # histogram is a usbreceiver.util.LatencyHistogram
+        family = self._family(name, "histogram", help_text)
+        labels = tuple(labels)
+        for bound, total in histogram.buckets():
+            family.append(self._sample(name + "_bucket", total, labels + (("le", _format_value(float(bound))),)))
+        family.append(self._sample(name + "_sum", float(histogram.sum), labels))
+        family.append(self._sample(name + "_count", histogram.count, labels))
+
+    def text(self):
+        return "\n".join(line for family in self.families.values() for line in family) + "\n"
+
+
+def collect(dexpy, ts_now=None):
+    if ts_now is None:
+        ts_now = time.time()
+    w = MetricsWriter()
+
+    w.gauge("dexpy_callback_queue_size", "Batches of received values waiting to be processed",
+            dexpy.callback_queue.qsize())
+    w.counter("dexpy_values_received_total", "Glucose values handed over by sources", dexpy.values_received)
+    w.counter("dexpy_values_duplicate_total", "Received glucose values that were already known",
+              dexpy.values_duplicate)
+    ratio = None
+    if dexpy.values_received > 0:
+        ratio = dexpy.values_duplicate / float(dexpy.values_received)
+    w.gauge("dexpy_dedup_hit_ratio", "Share of received glucose values dropped as duplicates", ratio)
+    try:
+        latest = dexpy.glucose_values[-1]
+    except IndexError:
+        latest = None
+    if latest is not None:
+        w.gauge("dexpy_latest_reading_age_seconds", "Age of the newest glucose value by source",
+                ts_now - latest.st, (("source", "any"), ("account", "")))
+
+    for name, worker in list(dexpy.sink_workers.items()):
+        labels = (("sink", name),)
+        w.gauge("dexpy_sink_pending", "Values waiting in the outbox of the sink after its last delivery",
+                worker.pending, labels)
+        w.gauge("dexpy_sink_lag_seconds", "Age of the oldest undelivered value of the sink after its last delivery",
+                worker.lag_seconds, labels)
+        w.counter("dexpy_sink_notified_total", "Values announced to the sink worker", worker.notified, labels)
+        w.counter("dexpy_sink_dropped_total", "Wake ups merged because the sink worker queue was full",
+                  worker.dropped, labels)
+        w.counter("dexpy_sink_drains_total", "Delivery rounds of the sink worker", worker.drains, labels)
+        w.gauge("dexpy_sink_drain_seconds", "Duration of the last delivery round", worker.drain_seconds, labels)
+        w.histogram("dexpy_sink_request_seconds", "Latency of requests to the sink, for mqtt from publish to ack",
+                    worker.request_latency, labels)
+        w.counter("dexpy_sink_request_errors_total", "Failed requests to the sink",
+                  worker.request_latency.errors, labels)
+    if dexpy.mqtt_client is not None:
+        w.gauge("dexpy_mqtt_inflight", "Published mqtt messages waiting for an ack", len(dexpy.mqtt_pending))
+        w.gauge("dexpy_mqtt_connected", "1 while connected to the mqtt server", 1 if dexpy.mqtt_connected else 0)
+
+    shares = []
+    if dexpy.dexcom_share_session is not None:
+        shares.append(dexpy.dexcom_share_session)
+    if dexpy.share_scheduler is not None:
+        shares.extend(dexpy.share_scheduler.sessions)
+        limiter = dexpy.share_scheduler.rate_limiter
+        if limiter is not None:
+            w.counter("dexpy_share_rate_limited_total", "Dexcom share requests delayed by the rate limit",
+                      limiter.waits)
+    for share in shares:
+        labels = (("source", "share"), ("account", share.name or ""))
+        w.histogram("dexpy_source_poll_seconds", "Duration of a source poll", share.poll_latency, labels)
+        w.counter("dexpy_share_requests_total", "Glucose value requests sent to dexcom share", share.requests,
+                  labels[1:])
+        w.counter("dexpy_share_logins_total", "Login requests sent to dexcom share", share.logins, labels[1:])
+        w.counter("dexpy_share_backfills_total", "Backfill requests sent to dexcom share", share.backfills,
+                  labels[1:])
+        if share.last_gv is not None:
+            w.gauge("dexpy_latest_reading_age_seconds", "Age of the newest glucose value by source",
+                    ts_now - share.last_gv.st, labels)
+
+    receiver = dexpy.dexcom_receiver_session
+    if receiver is not None:
+        w.histogram("dexpy_source_poll_seconds", "Duration of a source poll", receiver.poll_latency,
+                    (("source", "usb"), ("account", "")))
+        if receiver.last_gv is not None:
+            w.gauge("dexpy_latest_reading_age_seconds", "Age of the newest glucose value by source",
+                    ts_now - receiver.last_gv.st, (("source", "usb"), ("account", "")))
+        w.gauge("dexpy_usb_connected", "1 while the usb receiver is connected", 0 if receiver.device is None else 1)
+        for command, histogram in sorted(list(receiver.command_latencies.items())):
+            labels = (("command", command),)
+            w.histogram("dexpy_usb_command_seconds", "Latency of usb receiver commands", histogram, labels)
+            w.counter("dexpy_usb_command_errors_total", "Failed usb receiver commands", histogram.errors, labels)
+            w.counter("dexpy_usb_command_timeouts_total", "Timed out usb receiver commands",
+                      histogram.timeouts, labels)
+        w.gauge("dexpy_usb_clock_uncertainty_seconds", "Uncertainty of the estimated receiver clock offset",
+                receiver.clock_sync.uncertainty(ts_now))
+        if receiver.hotplug is not None:
+            w.counter("dexpy_usb_hotplug_events_total", "Receiver tty add and remove events seen",
+                      receiver.hotplug.events)
+    return w.text()
+
+
+class MetricsServer:
+    def __init__(self, dexpy, port, address=""):
+        self.logger = logging.getLogger('DEXPY')
+        self.dexpy = dexpy
+        self.port = port
+        self.address = address
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                try:
+                    data = collect(server.dexpy).encode("utf-8")
+                except Exception as ex:
+                    server.logger.error("Error collecting metrics", exc_info=ex)
+                    self.send_error(500)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, fmt, *args):
+                server.logger.debug("metrics: " + fmt % args)
+
+        try:
+            self.server = ThreadingHTTPServer((self.address, self.port), Handler)
+        except OSError as ex:
+            self.logger.error("Error starting metrics endpoint on port %d" % self.port, exc_info=ex)
+            return False
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="metrics")
+        self.thread.daemon = True
+        self.thread.start()
+        self.logger.info("serving metrics on port %d" % self.server.server_address[1])
+        return True
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
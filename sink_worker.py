@@ -0,0 +1,85 @@
+import logging
+import threading
+import time
+from queue import Queue, Empty, Full
+
+from usbreceiver.util import LatencyHistogram
+
+
+class SinkWorker:
+    # Delivers the outbox rows of a single sink on its own thread.
+    # Queue entries only wake the worker up, the rows themselves are in the outbox,
+    # so the "drop" policy coalesces wake ups of a busy sink without losing data while
+    # "block" holds up the dispatcher until the sink catches up.
+    def __init__(self, name, drain, store, queue_size=16, policy="drop", retry_interval=60):
+        self.logger = logging.getLogger('DEXPY')
+        self.name = name
+        self.drain = drain
+        self.store = store
+        self.queue = Queue(maxsize=queue_size)
+        self.policy = policy
+        self.retry_interval = retry_interval
+        self.exit_event = threading.Event()
+        self.thread = None
+
+        self.notified = 0
+        self.dropped = 0
+        self.drains = 0
+        self.drain_seconds = 0.0
+        self.lag_seconds = 0.0
+        self.pending = 0
+        # requests made by the drain function to the sink
+        self.request_latency = LatencyHistogram()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="sink-" + self.name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.exit_event.set()
+        try:
+            self.queue.put_nowait(None)
+        except Full:
+            pass
+        if self.thread is not None:
+            self.thread.join(timeout=30)
+
+    def notify(self, gvs):
+        self.notified += len(gvs)
+        try:
+            self.queue.put((time.time(), len(gvs)), block=self.policy == "block")
+        except Full:
+            self.dropped += 1
+
+    def run(self):
+        # drain what is left in the outbox from before a restart right away
+        ts_wake = time.time()
+        while not self.exit_event.is_set():
+            timeout = self.retry_interval
+            if ts_wake is not None:
+                timeout = max(0.0, ts_wake - time.time())
+            try:
+                self.queue.get(timeout=timeout)
+                while True:
+                    self.queue.get_nowait()
+            except Empty:
+                pass
+            if self.exit_event.is_set():
+                break
+
+            ts_start = time.time()
+            try:
+                ts_wake = self.drain()
+            except Exception as ex:
+                self.logger.error("Error delivering to %s" % self.name, exc_info=ex)
+                ts_wake = None
+            ts_end = time.time()
+            self.drains += 1
+            self.drain_seconds = ts_end - ts_start
+            self.update_lag(ts_end)
+
+    def update_lag(self, ts_now):
+        self.pending = self.store.outbox_count(self.name)
+        ts_oldest = self.store.outbox_oldest(self.name)
+        self.lag_seconds = 0.0 if ts_oldest is None else ts_now - ts_oldest
@@ -0,0 +1,24 @@
+import unittest
+
+from usbreceiver import crc16
+
+
+class Crc16Test(unittest.TestCase):
+
+  def test_known_checksum(self):
+    # CRC-CCITT (XModem) check value
+    self.assertEqual(0x31c3, crc16.crc16_python(b'123456789'))
+    self.assertEqual(0x31c3, crc16.crc16_binascii(b'123456789'))
+
+  def test_binascii_equivalent(self):
+    for seed in (0, 1, 2):
+      self.assertTrue(crc16.equivalent(crc16.crc16_binascii, rounds=200, seed=seed))
+
+  def test_detects_wrong_backend(self):
+    def off_by_one(buf, start=None, end=None):
+      return crc16.crc16_python(buf, start, end) ^ 1
+    self.assertFalse(crc16.equivalent(off_by_one, rounds=10, seed=0))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,187 @@
+import random
+import unittest
+
+from glucose import GlucoseIndex, GlucoseRing, GlucoseValue
+
+
+def gv(st, value=100.0, trend=4):
+    return GlucoseValue(None, None, st, value, trend)
+
+
+def as_tuple(v):
+    return None if v is None else (v.st, v.value, v.trend)
+
+
+class ReferenceRing:
+    # the ring's contract on a plain list: ordered by st, equal st in insertion
+    # order, the oldest value is pushed out once capacity is exceeded
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.values = []
+
+    def insert(self, v):
+        i = len([st for st, _, _ in self.values if st <= v.st])
+        self.values.insert(i, as_tuple(v))
+        if len(self.values) > self.capacity:
+            return self.values.pop(0)
+        return None
+
+
+class GlucoseRingTest(unittest.TestCase):
+
+    def assertSameContents(self, ring, reference):
+        self.assertEqual(reference.values, [as_tuple(v) for v in ring])
+        self.assertEqual(len(reference.values), len(ring))
+        for i, expected in enumerate(reference.values):
+            self.assertEqual(expected, as_tuple(ring[i]))
+            self.assertEqual(expected, as_tuple(ring[i - len(ring)]))
+
+    def check_against_reference(self, capacity, sts, seed):
+        ring = GlucoseRing(capacity)
+        reference = ReferenceRing(capacity)
+        rnd = random.Random(seed)
+        for n, st in enumerate(sts):
+            v = gv(float(st), float(n), rnd.randint(1, 7))
+            self.assertEqual(reference.insert(v), as_tuple(ring.insert(v)))
+            self.assertSameContents(ring, reference)
+
+    def test_random_against_reference(self):
+        for capacity in range(1, 9):
+            for seed in range(20):
+                rnd = random.Random(seed)
+                # few distinct st so equal st values are common
+                sts = [rnd.randint(0, 12) * 300 for _ in range(40)]
+                self.check_against_reference(capacity, sts, seed)
+
+    def test_wraps_around_with_ascending_values(self):
+        for capacity in (1, 2, 3, 5):
+            self.check_against_reference(capacity, range(0, 300 * 4 * capacity, 300), capacity)
+
+    def test_wraps_around_with_descending_values(self):
+        # every insert is in front of the head, which moves backwards over the start
+        for capacity in (2, 3, 5):
+            self.check_against_reference(capacity, [300 * (10 - i) for i in range(capacity)], capacity)
+            ring = GlucoseRing(capacity)
+            for st in (100, 200, 300, 50, 40, 30, 250):
+                ring.insert(gv(st))
+            self.assertEqual(sorted(v.st for v in ring), [v.st for v in ring])
+
+    def test_older_value_than_a_full_window_is_evicted_itself(self):
+        ring = GlucoseRing(3)
+        for st in (300, 600, 900):
+            self.assertIsNone(ring.insert(gv(st)))
+        rejected = gv(0)
+        self.assertIs(rejected, ring.insert(rejected))
+        self.assertEqual([300, 600, 900], [v.st for v in ring])
+
+    def test_equal_st_at_the_start_of_a_full_window(self):
+        ring = GlucoseRing(3)
+        for n, st in enumerate((300, 600, 900)):
+            ring.insert(gv(st, float(n)))
+        # lands after the value with the same st, which is evicted
+        self.assertEqual((300, 0.0, 4), as_tuple(ring.insert(gv(300, 9.0))))
+        self.assertEqual([(300, 9.0), (600, 1.0), (900, 2.0)], [(v.st, v.value) for v in ring])
+
+    def test_index_out_of_range(self):
+        ring = GlucoseRing(2)
+        ring.insert(gv(300))
+        with self.assertRaises(IndexError):
+            ring[1]
+        with self.assertRaises(IndexError):
+            ring[-2]
+
+    def test_between(self):
+        ring = GlucoseRing(8)
+        for st in (900, 300, 1200, 600, 600, 1500):
+            ring.insert(gv(st))
+        self.assertEqual([600, 600, 900], [v.st for v in ring.between(600, 900)])
+        self.assertEqual([], ring.between(0, 299))
+        self.assertEqual([1500], [v.st for v in ring.between(1500, 3000)])
+
+
+class GlucoseIndexTest(unittest.TestCase):
+
+    def index_of(self, *values):
+        index = GlucoseIndex()
+        for v in values:
+            index.add(v)
+        return index
+
+    def test_window_boundary_within_a_slot(self):
+        index = self.index_of(gv(1000))
+        self.assertIn(gv(1239), index)
+        self.assertNotIn(gv(1240), index)
+        self.assertIn(gv(761), index)
+        self.assertNotIn(gv(760), index)
+
+    def test_window_boundary_across_slots(self):
+        # 299 is the last second of slot 0, the neighbours are in slot 1
+        index = self.index_of(gv(299))
+        self.assertIn(gv(538), index)
+        self.assertIn(gv(538.9), index)
+        self.assertNotIn(gv(539), index)
+        index = self.index_of(gv(538))
+        self.assertIn(gv(299), index)
+        self.assertNotIn(gv(298), index)
+        self.assertIn(gv(298.5), index)
+
+    def test_values_straddling_a_slot_boundary(self):
+        index = self.index_of(gv(590))
+        self.assertIn(gv(610), index)
+        self.assertIn(gv(829), index)
+        self.assertNotIn(gv(830), index)
+        index = self.index_of(gv(610))
+        self.assertIn(gv(590), index)
+        self.assertIn(gv(371), index)
+        self.assertNotIn(gv(370), index)
+
+    def test_matches_same_ts_and_rounded_value(self):
+        index = self.index_of(gv(1000, 100.4))
+        self.assertIn(gv(1100, 99.6), index)
+        self.assertNotIn(gv(1100, 101.0), index)
+        for st in range(0, 2000, 7):
+            for value in (99.0, 100.0, 101.0):
+                probe = gv(st, value)
+                self.assertEqual(probe == gv(1000, 100.4), probe in index)
+
+    def test_discard(self):
+        index = self.index_of(gv(1000, 100.0), gv(1000, 100.0), gv(1200, 100.0))
+        self.assertEqual(3, len(index))
+        index.discard(gv(1000, 100.2))
+        self.assertEqual(2, len(index))
+        self.assertIn(gv(1000), index)
+        index.discard(gv(1000))
+        index.discard(gv(1000))
+        self.assertEqual(1, len(index))
+        self.assertNotIn(gv(900), index)
+        self.assertIn(gv(1000), index)
+        index.discard(gv(1200))
+        self.assertEqual(0, len(index))
+        self.assertEqual({}, index.slots)
+
+    def test_discard_after_eviction(self):
+        # as dexpy keeps them, the index holds exactly the values in the ring
+        ring = GlucoseRing(3)
+        index = GlucoseIndex()
+        values = [gv(st, 100.0 + st // 300) for st in range(0, 300 * 10, 300)]
+        for n, v in enumerate(values):
+            index.add(v)
+            evicted = ring.insert(v)
+            if evicted is not None:
+                index.discard(evicted)
+            self.assertEqual(len(ring), len(index))
+            for old in values[:max(0, n - 2)]:
+                self.assertNotIn(old, index)
+            for kept in values[max(0, n - 2):n + 1]:
+                self.assertIn(kept, index)
+
+        # a value older than the full window is evicted right away
+        old = gv(0, 100.0)
+        index.add(old)
+        index.discard(ring.insert(old))
+        self.assertNotIn(old, index)
+        self.assertEqual(3, len(index))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from usbreceiver import constants
+from usbreceiver.hotplug import HotplugWatcher, parse_uevent
+
+RECEIVER_USB = '/devices/pci0000:00/0000:00:14.0/usb1/1-2'
+RECEIVER_DEVPATH = RECEIVER_USB + '/1-2:1.0/tty/ttyACM0'
+OTHER_USB = '/devices/pci0000:00/0000:00:14.0/usb1/1-3'
+OTHER_DEVPATH = OTHER_USB + '/1-3:1.0/ttyUSB0/tty/ttyUSB0'
+
+
+def uevent(action, devpath, devname, subsystem='tty'):
+  fields = ['%s@%s' % (action, devpath), 'ACTION=' + action, 'DEVPATH=' + devpath,
+            'SUBSYSTEM=' + subsystem, 'DEVNAME=' + devname, 'MAJOR=166', 'MINOR=0', 'SEQNUM=4711']
+  return '\0'.join(fields).encode('utf-8') + b'\0'
+
+
+class HotplugWatcherTest(unittest.TestCase):
+
+  def setUp(self):
+    self.root = tempfile.mkdtemp(prefix='dexpy-hotplug-')
+    self.sysfs = os.path.join(self.root, 'sys')
+    self.dev = os.path.join(self.root, 'dev')
+    os.makedirs(os.path.join(self.sysfs, 'class', 'tty'))
+    os.makedirs(self.dev)
+    self.ports = []
+    self.watcher = HotplugWatcher(self.ports.append, sysfs_root=self.sysfs, dev_root=self.dev,
+                                  node_timeout=0.1)
+
+  def tearDown(self):
+    shutil.rmtree(self.root)
+
+  def plug(self, usb_devpath, devpath, vendor, product):
+    # the ids are on the usb device, a few levels above the tty
+    tty = os.path.join(self.sysfs, devpath.lstrip('/'))
+    os.makedirs(tty)
+    usb_device = os.path.join(self.sysfs, usb_devpath.lstrip('/'))
+    with open(os.path.join(usb_device, 'idVendor'), 'w') as f:
+      f.write('%04x\n' % vendor)
+    with open(os.path.join(usb_device, 'idProduct'), 'w') as f:
+      f.write('%04x\n' % product)
+    name = os.path.basename(devpath)
+    os.symlink(tty, os.path.join(self.sysfs, 'class', 'tty', name))
+    open(os.path.join(self.dev, name), 'w').close()
+
+  def unplug(self, devpath):
+    name = os.path.basename(devpath)
+    os.unlink(os.path.join(self.sysfs, 'class', 'tty', name))
+    os.unlink(os.path.join(self.dev, name))
+
+  def plug_receiver(self):
+    self.plug(RECEIVER_USB, RECEIVER_DEVPATH, constants.DEXCOM_G4_USB_VENDOR, constants.DEXCOM_G4_USB_PRODUCT)
+
+  def plug_other(self):
+    self.plug(OTHER_USB, OTHER_DEVPATH, 0x0403, 0x6001)
+
+  def test_parse_uevent(self):
+    properties = parse_uevent(uevent('add', RECEIVER_DEVPATH, 'ttyACM0'))
+    self.assertEqual('add', properties['ACTION'])
+    self.assertEqual(RECEIVER_DEVPATH, properties['DEVPATH'])
+    self.assertEqual('ttyACM0', properties['DEVNAME'])
+
+  def test_find(self):
+    self.assertIsNone(self.watcher.find())
+    self.plug_other()
+    self.assertIsNone(self.watcher.find())
+    self.plug_receiver()
+    self.assertEqual(os.path.join(self.dev, 'ttyACM0'), self.watcher.find())
+    self.assertEqual(os.path.join(self.dev, 'ttyACM0'), self.watcher.find_port())
+
+  def test_add_and_remove(self):
+    port = os.path.join(self.dev, 'ttyACM0')
+    self.plug_receiver()
+    self.assertTrue(self.watcher.feed(uevent('add', RECEIVER_DEVPATH, 'ttyACM0')))
+    self.assertEqual(port, self.watcher.port)
+    self.assertEqual([port], self.ports)
+
+    self.assertFalse(self.watcher.feed(uevent('add', RECEIVER_DEVPATH, 'ttyACM0')))
+    self.assertEqual([port], self.ports)
+
+    self.unplug(RECEIVER_DEVPATH)
+    self.assertTrue(self.watcher.feed(uevent('remove', RECEIVER_DEVPATH, 'ttyACM0')))
+    self.assertIsNone(self.watcher.port)
+    self.assertEqual([port, None], self.ports)
+    self.assertEqual(3, self.watcher.events)
+
+  def test_absolute_devname(self):
+    self.plug_receiver()
+    self.assertTrue(self.watcher.feed(uevent('add', RECEIVER_DEVPATH, '/dev/ttyACM0')))
+    self.assertEqual(os.path.join(self.dev, 'ttyACM0'), self.watcher.port)
+
+  def test_ignores_other_devices(self):
+    self.plug_other()
+    self.assertFalse(self.watcher.feed(uevent('add', OTHER_DEVPATH, 'ttyUSB0')))
+    self.assertFalse(self.watcher.feed(uevent('add', '/devices/virtual/tty/tty1', 'tty1')))
+    self.assertFalse(self.watcher.feed(uevent('add', RECEIVER_USB, 'bus/usb/001/002',
+                                              subsystem='usb')))
+    self.assertIsNone(self.watcher.port)
+    self.assertEqual([], self.ports)
+
+  def test_remove_of_another_tty_keeps_the_port(self):
+    self.plug_receiver()
+    self.plug_other()
+    self.watcher.feed(uevent('add', RECEIVER_DEVPATH, 'ttyACM0'))
+    self.assertFalse(self.watcher.feed(uevent('remove', OTHER_DEVPATH, 'ttyUSB0')))
+    self.assertEqual(os.path.join(self.dev, 'ttyACM0'), self.watcher.port)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -38,6 +38,10 @@ class CrcError(Error):
   """Failed to CRC properly."""
 
 
+class TimeoutError(Error):
+  """The receiver did not answer before the deadline."""
+
+
 DEXCOM_G4_USB_VENDOR = 0x22a3
 DEXCOM_G4_USB_PRODUCT = 0x0047
 
@@ -90,6 +94,11 @@ WRITE_CHARGER_CURRENT_SETTING = 60
 MAX_COMMAND = 61
 MAX_POSSIBLE_COMMAND = 255
 
+# 28 byte page header followed by 500 bytes of records
+DATABASE_PAGE_SIZE = 528
+# pages that fit into the 1584 byte payload of a single response
+MAX_PAGES_PER_READ = 3
+
 EGV_VALUE_MASK = 1023
 EGV_DISPLAY_ONLY_MASK = 32768
 EGV_TREND_ARROW_MASK = 15
@@ -54,6 +54,10 @@ from usbreceiver import constants, util
 EGV_TESTNUM_MASK = 0x00ffffff
 
 class BaseDatabaseRecord(object):
+  # Records are views into the page buffer they were read from, the fields
+  # are only unpacked when first accessed. Subclasses declare __slots__ too,
+  # so that records do not carry an instance dict.
+  __slots__ = ('_buf', '_offset', '_data')
   FORMAT = None
 
   @classmethod
@@ -64,8 +68,13 @@ class BaseDatabaseRecord(object):
 
   @classmethod
   def _ClassFormat(cls):
-    cls._CheckFormat()
-    return struct.Struct(cls.FORMAT)
+    # cached per class, subclasses may override FORMAT
+    fmt = cls.__dict__.get('_struct')
+    if fmt is None or fmt.format != cls.FORMAT:
+      cls._CheckFormat()
+      fmt = struct.Struct(cls.FORMAT)
+      cls._struct = fmt
+    return fmt
 
   @classmethod
   def _ClassSize(cls):
@@ -82,12 +91,28 @@ class BaseDatabaseRecord(object):
 
   @property
   def crc(self):
-    return self.data[-1]
+    raw = self.raw_data
+    return raw[-2] | (raw[-1] << 8)
 
-  def __init__(self, data, raw_data):
-    self.raw_data = raw_data
-    self.data = data
-    self.check_crc()
+  @property
+  def data(self):
+    if self._data is None:
+      self._data = self._ClassFormat().unpack_from(self._buf, self._offset)
+    return self._data
+
+  @property
+  def raw_data(self):
+    size = self._ClassSize()
+    if self._offset == 0 and len(self._buf) <= size:
+      return self._buf
+    return memoryview(self._buf)[self._offset:self._offset + size]
+
+  def __init__(self, data, raw_data, verified=False, offset=0):
+    self._buf = raw_data
+    self._offset = offset
+    self._data = data
+    if not verified:
+      self.check_crc()
 
   def check_crc(self):
     local_crc = self.calculate_crc()
@@ -95,20 +120,19 @@ class BaseDatabaseRecord(object):
       raise constants.CrcError('Could not parse %s' % self.__class__.__name__)
 
   def dump(self):
-    return ''.join(' %02x' % ord(c) for c in self.raw_data)
+    return ''.join(' %02x' % c for c in self.raw_data)
 
   def calculate_crc(self):
-    return usbreceiver.crc16.crc16(self.raw_data[:-2])
+    raw = self.raw_data
+    return usbreceiver.crc16.crc16(raw, 0, len(raw) - 2)
 
   @classmethod
   def Create(cls, data, record_counter):
-    offset = record_counter * cls._ClassSize()
-    raw_data = data[offset:offset + cls._ClassSize()]
-    unpacked_data = cls._ClassFormat().unpack(raw_data)
-    return cls(unpacked_data, raw_data)
+    return cls(None, data, offset=record_counter * cls._ClassSize())
 
 
 class GenericTimestampedRecord(BaseDatabaseRecord):
+  __slots__ = ()
   FIELDS = [ ]
   BASE_FIELDS = [ 'system_time', 'display_time' ]
 
@@ -137,15 +161,17 @@ class GenericTimestampedRecord(BaseDatabaseRecord):
     return d
 
 class GenericXMLRecord(GenericTimestampedRecord):
+  __slots__ = ()
   FORMAT = '<II490sH'
 
   @property
   def xmldata(self):
-    data = self.data[2].replace("\x00", "")
+    data = self.data[2].replace(b"\x00", b"").decode('utf-8')
     return data
 
 
 class InsertionRecord(GenericTimestampedRecord):
+  __slots__ = ()
   FIELDS = ['insertion_time', 'session_state']
   FORMAT = '<3IBH'
 
@@ -176,6 +202,7 @@ class InsertionRecord(GenericTimestampedRecord):
     return '%s:  state=%s' % (self.display_time, self.session_state)
 
 class G5InsertionRecord (InsertionRecord):
+  __slots__ = ()
   FORMAT = '<3IBI6sH'
 
   @property
@@ -187,6 +214,7 @@ class G5InsertionRecord (InsertionRecord):
     return self.data[5]     # a 6-byte string
 
 class G5UserSettings (GenericTimestampedRecord):
+  __slots__ = ()
   # {'RecordLength': '50', 'Name': 'UserSettingData', 'RecordRevision': '5', 'Id': '12'}
   FORMAT = '<4I6sI8HBBIH'   # total length = 50
                             # Values in positions 2,3,5,13,15, 16 are unknown
@@ -220,6 +248,7 @@ class G5UserSettings (GenericTimestampedRecord):
     return self.data[14]
 
 class G6UserSettings (GenericTimestampedRecord):
+  __slots__ = ()
   # {'RecordLength': '60', 'Name': 'UserSettingData', 'RecordRevision': '6', 'Id': '12'}
   FORMAT = '<4I6sI8HBBHB4s7BH'   # total length = 60
                             # Values in positions 2,3,5,13,15,17 are unknown
@@ -260,6 +289,7 @@ class G6UserSettings (GenericTimestampedRecord):
   
 
 class Calibration(GenericTimestampedRecord):
+  __slots__ = ('subcals',)
   FORMAT = '<2Iddd3cdb'
   # CAL_FORMAT = '<2Iddd3cdb'
   FIELDS = [ 'slope', 'intercept', 'scale', 'decay', 'numsub', 'raw' ]
@@ -302,10 +332,14 @@ class Calibration(GenericTimestampedRecord):
     unpacked_data = cls._ClassFormat().unpack(cal_data)
     return cls(unpacked_data, raw_data)
 
+  @property
+  def page_data(self):
+    return self._buf
+
   def __init__ (self, data, raw_data):
-    self.page_data = raw_data
-    self.raw_data = raw_data
-    self.data = data
+    self._buf = raw_data
+    self._offset = 0
+    self._data = data
     subsize = struct.calcsize(SubCal.FORMAT)
     offset = self.numsub * subsize
     calsize = struct.calcsize(self.FORMAT)
@@ -332,6 +366,7 @@ class Calibration(GenericTimestampedRecord):
     return struct.unpack('H', self.raw_data[-2:])[0]
 
 class LegacyCalibration (Calibration):
+  __slots__ = ()
   @classmethod
   def _ClassSize(cls):
 
@@ -339,12 +374,14 @@ class LegacyCalibration (Calibration):
 
 
 class SubCal (GenericTimestampedRecord):
+  __slots__ = ('displayOffset',)
   FORMAT = '<IIIIc'
   BASE_FIELDS = [ ]
   FIELDS = [ 'entered', 'meter',  'sensor', 'applied', ]
   def __init__ (self, raw_data, displayOffset=None):
-    self.raw_data = raw_data
-    self.data = self._ClassFormat().unpack(raw_data)
+    self._buf = raw_data
+    self._offset = 0
+    self._data = None
     self.displayOffset = displayOffset
   @property
   def entered  (self):
@@ -360,6 +397,7 @@ class SubCal (GenericTimestampedRecord):
     return util.ReceiverTimeToTime(self.data[3])
 
 class MeterRecord(GenericTimestampedRecord):
+  __slots__ = ()
   #  0 = system_time = uint (4 bytes)
   #  1 = display_time = uint (4 bytes)
   #  2 = meter_glucose = ushort (2 bytes)
@@ -380,6 +418,7 @@ class MeterRecord(GenericTimestampedRecord):
     return '%s: Meter BG:%s' % (self.display_time, self.meter_glucose)
 
 class G5MeterRecord (GenericTimestampedRecord):
+  __slots__ = ()
   #  0 = system_time = uint (4 bytes)
   #  1 = display_time = uint (4 bytes)
   #  2 = meter_glucose = ushort (2 bytes)
@@ -392,6 +431,7 @@ class G5MeterRecord (GenericTimestampedRecord):
 
 
 class EventRecord(GenericTimestampedRecord):
+  __slots__ = ()
   # sys_time,display_time,glucose,meter_time,crc
   FORMAT = '<2I2B2IH'
   FIELDS = ['event_type', 'event_sub_type', 'event_value' ]
@@ -443,6 +483,7 @@ class EventRecord(GenericTimestampedRecord):
                                     self.event_sub_type, self.event_value)
 
 class SensorRecord(GenericTimestampedRecord):
+  __slots__ = ()
   # uint, uint, uint, uint, ushort
   # (system_seconds, display_seconds, unfiltered, filtered, rssi, crc)
   FORMAT = '<2IIIhH'
@@ -462,6 +503,7 @@ class SensorRecord(GenericTimestampedRecord):
 
 
 class EGVRecord(GenericTimestampedRecord):
+  __slots__ = ()
   #  0 = system_time = uint (4 bytes)
   #  1 = display_time = uint (4 bytes)
   #  2 = glucose = ushort (2 bytes)
@@ -516,6 +558,7 @@ class EGVRecord(GenericTimestampedRecord):
 
 
 class G5EGVRecord (EGVRecord):
+  __slots__ = ()
   #  0 = systemTime = integer (4 bytes)
   #  1 = displayTime = integer (4 bytes)
   #  2 = glucose value = ushort (2 bytes)
@@ -0,0 +1,47 @@
+import threading
+
+
+class DeviceInfo(object):
+  """Metadata of a receiver that does not change while it stays plugged in.
+
+  The transmitter id is not among it, pairing a new transmitter changes it
+  without a reconnect.
+  """
+
+  def __init__(self, firmware_header, firmware_version, device_type, parser_map):
+    self.firmware_header = firmware_header
+    self.firmware_version = firmware_version
+    self.device_type = device_type
+    self.parser_map = parser_map
+    self.usb_serial = None
+    self.serial = None
+    self.manufacturing_data = None
+
+
+class DeviceInfoCache(object):
+  """DeviceInfo by USB and manufacturing serial number, kept across reconnects.
+
+  An entry is only used when the receiver still returns exactly the same raw
+  firmware header, see Dexcom.LoadDeviceInfo().
+  """
+
+  def __init__(self):
+    self._infos = {}
+    self._lock = threading.Lock()
+
+  def get(self, key):
+    if key is None:
+      return None
+    with self._lock:
+      return self._infos.get(key)
+
+  def put(self, info):
+    with self._lock:
+      for key in (('usb', info.usb_serial), ('serial', info.serial)):
+        if key[1] is not None:
+          self._infos[key] = info
+
+  def discard(self, info):
+    with self._lock:
+      for key in [k for k, v in self._infos.items() if v is info]:
+        del self._infos[key]
@@ -0,0 +1,181 @@
+import errno
+import logging
+import os
+import re
+import socket
+import threading
+import time
+
+from usbreceiver import constants
+
+NETLINK_KOBJECT_UEVENT = 15
+# multicast group of the uevents sent by the kernel itself
+UEVENT_KERNEL_GROUP = 1
+
+DEV_REGEX = re.compile('^tty(USB|ACM)[0-9]+$')
+
+
+def parse_uevent(data):
+  """Returns the properties of a kernel uevent datagram as a dict."""
+  fields = data.split(b'\0')
+  properties = {}
+  for field in fields[1:]:
+    key, sep, value = field.partition(b'=')
+    if sep:
+      properties[key.decode('utf-8', 'replace')] = value.decode('utf-8', 'replace')
+  return properties
+
+
+class HotplugWatcher(object):
+  """Tracks the tty of the receiver from kernel uevents.
+
+  The port is looked up once through /sys/class/tty and then kept up to date
+  from the add and remove events of tty devices on a netlink socket, so
+  finding the receiver costs nothing while it stays plugged in or away.
+  Without netlink (other platforms, restricted containers) find_port() does
+  the /sys/class/tty lookup each time, which only reads the ids of existing
+  serial ttys instead of walking every USB device.
+  """
+
+  def __init__(self, callback=None, vendor=constants.DEXCOM_G4_USB_VENDOR,
+               product=constants.DEXCOM_G4_USB_PRODUCT, sysfs_root='/sys',
+               dev_root='/dev', node_timeout=2.0):
+    self.logger = logging.getLogger('DEXPY')
+    self.callback = callback
+    self.ids = ('%04x' % vendor, '%04x' % product)
+    self.sysfs_root = sysfs_root
+    self.dev_root = dev_root
+    self.node_timeout = node_timeout
+    self.port = None
+    self.events = 0
+    self._sock = None
+    self._thread = None
+    self._lock = threading.Lock()
+
+  @property
+  def listening(self):
+    return self._sock is not None
+
+  def start(self):
+    try:
+      sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM,
+                           NETLINK_KOBJECT_UEVENT)
+      sock.bind((0, UEVENT_KERNEL_GROUP))
+    except (AttributeError, OSError) as e:
+      self.logger.info("usb hotplug events not available, looking up the receiver on each poll: %s" % e)
+      return False
+    # events that arrive between the lookup and the first recv are still queued
+    self._sock = sock
+    self.port = self.find()
+    self._thread = threading.Thread(target=self.run, name="usb-hotplug")
+    self._thread.daemon = True
+    self._thread.start()
+    return True
+
+  def stop(self):
+    sock, self._sock = self._sock, None
+    if sock is not None:
+      try:
+        sock.shutdown(socket.SHUT_RDWR)
+      except OSError:
+        pass
+      sock.close()
+
+  def run(self):
+    while True:
+      sock = self._sock
+      if sock is None:
+        break
+      try:
+        data = sock.recv(8192)
+      except OSError as e:
+        if e.errno == errno.ENOBUFS and self._sock is sock:
+          # events were dropped, the port has to be looked up again
+          self.logger.info("usb hotplug events lost, looking up the receiver again")
+          with self._lock:
+            self.port = self.find()
+          continue
+        if self._sock is sock:
+          self.logger.warning("usb hotplug events no longer available, looking up the receiver on each poll: %s" % e)
+          self.stop()
+        break
+      if not data:
+        if self._sock is sock:
+          self.stop()
+        break
+      try:
+        self.feed(data)
+      except Exception as ex:
+        self.logger.error("Error handling usb hotplug event", exc_info=ex)
+
+  def find_port(self):
+    # an idle poll also recovers from a missed add event
+    if self.listening and self.port is not None:
+      return self.port
+    port = self.find()
+    if self.listening:
+      with self._lock:
+        if self.port is None:
+          self.port = port
+    return port
+
+  def find(self):
+    """Looks the receiver up among the serial ttys in sysfs."""
+    tty_class = os.path.join(self.sysfs_root, 'class', 'tty')
+    try:
+      names = sorted(os.listdir(tty_class))
+    except OSError:
+      return None
+    for name in names:
+      if DEV_REGEX.match(name) and self._matches(os.path.realpath(os.path.join(tty_class, name))):
+        return os.path.join(self.dev_root, name)
+    return None
+
+  def _matches(self, path):
+    # the USB device holding the ids is a few levels above the tty
+    for _ in range(5):
+      path = os.path.dirname(path)
+      try:
+        with open(os.path.join(path, 'idVendor')) as f:
+          vendor = f.read().strip()
+        with open(os.path.join(path, 'idProduct')) as f:
+          product = f.read().strip()
+      except (OSError, IOError):
+        continue
+      return (vendor, product) == self.ids
+    return False
+
+  def feed(self, data):
+    """Handles one uevent datagram, returns True if the port changed."""
+    properties = parse_uevent(data)
+    if properties.get('SUBSYSTEM') != 'tty':
+      return False
+    name = os.path.basename(properties.get('DEVNAME', ''))
+    if not DEV_REGEX.match(name):
+      return False
+    action = properties.get('ACTION')
+    self.events += 1
+    port = os.path.join(self.dev_root, name)
+    with self._lock:
+      if action == 'add':
+        devpath = properties.get('DEVPATH', '').lstrip('/')
+        if self.port is not None or not self._matches(os.path.join(self.sysfs_root, devpath)):
+          return False
+        self._wait_for_node(port)
+        self.port = port
+      elif action == 'remove':
+        if self.port != port:
+          return False
+        self.port = None
+      else:
+        return False
+    self.logger.info("usb receiver %s: %s" % ("attached" if action == 'add' else "detached", port))
+    if self.callback is not None:
+      self.callback(self.port)
+    return True
+
+  def _wait_for_node(self, port):
+    # the kernel event comes before udev has created the device node
+    ts_end = time.time() + self.node_timeout
+    while not os.path.exists(port) and time.time() < ts_end:
+      time.sleep(0.01)
@@ -27,9 +27,43 @@
 #
 #########################################################################
 
-import usbreceiver.crc16
+import functools
 import struct
 
+import usbreceiver.crc16
+
+
+def _payload_bytes(payload):
+  if payload is None:
+    return b''
+  if isinstance(payload, (bytes, bytearray, memoryview)):
+    return bytes(payload)
+  if isinstance(payload, str):
+    return payload.encode('latin-1')
+  if isinstance(payload, (tuple, list)):
+    return b''.join(_payload_bytes(b) for b in payload)
+  raise Exception('unknown type passed as packet')
+
+
+def EncodePacket(command, payload=None):
+  payload = _payload_bytes(payload)
+  packet = bytearray(len(payload) + PacketWriter.MIN_LEN)
+  length = len(packet)
+  packet[PacketWriter.OFFSET_SOF] = PacketWriter.SOF
+  struct.pack_into('<H', packet, PacketWriter.OFFSET_LENGTH, length)
+  packet[PacketWriter.OFFSET_CMD] = command
+  packet[PacketWriter.OFFSET_PAYLOAD:length - 2] = payload
+  struct.pack_into('<H', packet, length - 2,
+                   usbreceiver.crc16.crc16(packet, 0, length - 2))
+  return packet
+
+
+@functools.lru_cache(maxsize=128)
+def CachedPacket(command, payload=b''):
+  """Encoded packet for commands with no or a small fixed payload."""
+  return bytes(EncodePacket(command, payload))
+
+
 class PacketWriter(object):
   MAX_PAYLOAD = 1584
   MIN_LEN = 6
@@ -47,34 +81,14 @@ class PacketWriter(object):
     self._packet = None
 
   def NewSOF(self, v):
-    self._packet[0] = chr(v)
+    self._packet[0] = v
 
   def PacketString(self):
-    return ''.join(self._packet)
+    return self._packet.decode('latin-1')
 
   def get_packet_bytes(self):
     return bytes(self._packet)
- 
-  def AppendCrc(self):
-    self.SetLength()
-    crc = usbreceiver.crc16.crc16(self._packet, 0, len(self._packet))
-    for x in struct.pack('H', crc):
-      self._packet.append(x)
-
-  def SetLength(self):
-    self._packet[1] = len(self._packet) + 2
 
   def ComposePacket(self, command, payload=None):
     assert self._packet is None
-    self._packet = [1, None, 0, command]
-    if payload is not None:
-      for b in payload:
-        if type(b) is str:
-          for x in b:
-            self._packet.append(ord(x))
-        elif type(b) is bytes:
-          for x in b:
-            self._packet.append(int(x))
-        else:
-          raise Exception('unknown type passed as packet')
-    self.AppendCrc()
+    self._packet = EncodePacket(command, payload)
@@ -0,0 +1,86 @@
+import collections
+import os
+import threading
+
+
+class PageCache(object):
+  """LRU cache of closed receiver database pages.
+
+  Pages other than the last one of a partition never change on the receiver,
+  so their raw contents are kept keyed by (serial, record_type, page) within
+  a byte budget. With a directory set, pages are also stored on disk and
+  survive restarts.
+  """
+
+  def __init__(self, max_bytes=1024 * 1024, directory=None):
+    self.max_bytes = max_bytes
+    self.directory = directory
+    self.size = 0
+    self.hits = 0
+    self.misses = 0
+    self._pages = collections.OrderedDict()
+    self._lock = threading.Lock()
+    if directory is not None:
+      os.makedirs(directory, exist_ok=True)
+
+  def _path(self, key):
+    return os.path.join(self.directory, '%s-%s-%d.page' % key)
+
+  def get(self, key):
+    with self._lock:
+      data = self._pages.get(key)
+      if data is not None:
+        self._pages.move_to_end(key)
+        self.hits += 1
+        return data
+    if self.directory is not None:
+      try:
+        with open(self._path(key), 'rb') as f:
+          data = f.read()
+      except OSError:
+        data = None
+      if data is not None:
+        self._store(key, data)
+        self.hits += 1
+        return data
+    self.misses += 1
+    return None
+
+  def put(self, key, data):
+    data = bytes(data)
+    self._store(key, data)
+    if self.directory is not None:
+      path = self._path(key)
+      try:
+        with open(path + '.tmp', 'wb') as f:
+          f.write(data)
+        os.replace(path + '.tmp', path)
+      except OSError:
+        pass
+
+  def _store(self, key, data):
+    with self._lock:
+      old = self._pages.pop(key, None)
+      if old is not None:
+        self.size -= len(old)
+      self._pages[key] = data
+      self.size += len(data)
+      while self.size > self.max_bytes and self._pages:
+        _, evicted = self._pages.popitem(last=False)
+        self.size -= len(evicted)
+
+  def discard_from(self, serial, record_type, page):
+    """Drops the pages of a partition starting with the given page."""
+    with self._lock:
+      for key in [k for k in self._pages
+                  if k[0] == serial and k[1] == record_type and k[2] >= page]:
+        self.size -= len(self._pages.pop(key))
+    if self.directory is not None:
+      prefix = '%s-%s-' % (serial, record_type)
+      for name in os.listdir(self.directory):
+        if name.startswith(prefix) and name.endswith('.page'):
+          try:
+            if int(name[len(prefix):-5]) >= page:
+              os.remove(os.path.join(self.directory, name))
+          except (ValueError, OSError):
+            pass
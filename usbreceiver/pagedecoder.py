@@ -0,0 +1,68 @@
+import usbreceiver.crc16
+
+from usbreceiver import constants, database_records
+
+
+def decodes_in_bulk(record_type):
+  """True for fixed size records that use the generic Create()."""
+  return (record_type.Create.__func__ is database_records.BaseDatabaseRecord.Create.__func__
+          and record_type.FORMAT is not None)
+
+
+class RecordPage(object):
+  """All records of a database page, checked in one pass over the page buffer.
+
+  The fields of all records are unpacked together the first time rows or
+  columns are requested. Record objects are only created when a record is
+  accessed and share the page buffer.
+  """
+
+  def __init__(self, record_type, data, count):
+    self.record_type = record_type
+    self.size = record_type._ClassSize()
+    self.count = count
+    self._data = memoryview(data)[:count * self.size]
+    if len(self._data) != count * self.size:
+      raise constants.Error('Page too short for %d %s records'
+                            % (count, record_type.__name__))
+    self._rows = None
+    self._columns = None
+    self.check_crcs()
+
+  def check_crcs(self):
+    crc16 = usbreceiver.crc16.crc16
+    size = self.size
+    data = self._data
+    for offset in range(0, self.count * size, size):
+      end = offset + size
+      if crc16(data, offset, end - 2) != data[end - 2] | (data[end - 1] << 8):
+        raise constants.CrcError('Could not parse %s' % self.record_type.__name__)
+
+  @property
+  def rows(self):
+    if self._rows is None:
+      self._rows = list(self.record_type._ClassFormat().iter_unpack(self._data))
+    return self._rows
+
+  def column(self, index):
+    if self._columns is None:
+      self._columns = list(zip(*self.rows))
+    return self._columns[index] if self._columns else ()
+
+  def raw(self, i):
+    return self._data[i * self.size:(i + 1) * self.size]
+
+  def __len__(self):
+    return self.count
+
+  def __getitem__(self, i):
+    if i < 0:
+      i += self.count
+    if i < 0 or i >= self.count:
+      raise IndexError('record index out of range')
+    row = self._rows[i] if self._rows is not None else None
+    return self.record_type(row, self._data, verified=True, offset=i * self.size)
+
+  def __iter__(self):
+    for i in range(self.count):
+      yield self[i]
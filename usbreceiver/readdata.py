@@ -40,6 +40,7 @@
 #########################################################################
 from msgpack.fallback import xrange
 
+import collections
 import usbreceiver.crc16
 import usbreceiver.constants
 import usbreceiver.database_records
@@ -56,6 +57,10 @@ import platform
 
 # Some services are only to be invoked on unix-based OSs
 from usbreceiver import database_records, constants, util, packetwriter
+from usbreceiver.deviceinfo import DeviceInfo
+from usbreceiver.pagecache import PageCache
+from usbreceiver.pagedecoder import RecordPage, decodes_in_bulk
+from usbreceiver.transport import FramedTransport
 
 if sys.platform == "linux" or sys.platform == "linux2" or sys.platform == "darwin":
     import grp
@@ -63,6 +68,33 @@ if sys.platform == "linux" or sys.platform == "linux2" or sys.platform == "darwi
     import os
 
 
+COMMAND_NAMES = dict(
+  (getattr(constants, name), name) for name in dir(constants)
+  if name.startswith(('READ_', 'WRITE_')) or name in
+  ('PING', 'RESET_RECEIVER', 'ERASE_DATABASE', 'SHUTDOWN_RECEIVER'))
+
+# commands that can be sent again when the response was lost
+IDEMPOTENT_COMMANDS = frozenset(
+  [command for command, name in COMMAND_NAMES.items()
+   if name.startswith('READ_')] + [constants.PING])
+
+# payload length of fixed size responses, a reply of another size belongs to
+# an earlier command
+RESPONSE_LENGTHS = {
+  constants.PING: 0,
+  constants.READ_DATABASE_PAGE_RANGE: 8,
+  constants.READ_LANGUAGE: 2,
+  constants.READ_BATTERY_LEVEL: 4,
+  constants.READ_BATTERY_STATE: 1,
+  constants.READ_RTC: 4,
+  constants.READ_SYSTEM_TIME: 4,
+  constants.READ_SYSTEM_TIME_OFFSET: 4,
+  constants.READ_DISPLAY_TIME_OFFSET: 4,
+  constants.READ_GLUCOSE_UNIT: 1,
+  constants.READ_CLOCK_MODE: 1,
+}
+
+
 class ReadPacket(object):
 
   def __init__(self, command, data):
@@ -107,6 +139,11 @@ class Dexcom(object):
     'USER_SETTING_DATA': database_records.G6UserSettings,
     'BACKFILLED_EGV': database_records.G5EGVRecord }
 
+  DEFAULT_TIMEOUT = 2.0
+  COMMAND_TIMEOUTS = {
+    constants.READ_DATABASE_PAGES: 5.0,
+  }
+
   @staticmethod
   def FindDevice():
     try:
@@ -116,35 +153,76 @@ class Dexcom(object):
         return None
   def GetDeviceType(self):
     try:
-        device = self.FindDevice()
-        if not device:
-          sys.stderr.write('Could not find Dexcom G4|G5|G6 Receiver!\n')
-          return None
-        else:
-          fw_ver = self.GetFirmwareHeader().get('FirmwareVersion')
-          if fw_ver.startswith("4."):   # Not sure about G4 firmware versions
-            self.PARSER_MAP = self.G4_PARSER_MAP
-            return 'g4'
-          elif fw_ver.startswith("5.0."): # 5.0.1.043 = G5 Receiver Firmware
-            self.PARSER_MAP = self.G5_PARSER_MAP
-            return 'g5'
-          elif fw_ver.startswith("5."):   # 5.1.1.022 = G6 Receiver Firmware
-            self.PARSER_MAP = self.G6_PARSER_MAP
-            return 'g6'
-          else: # unrecognized firmware version
-              return fw_ver
+        return self.LoadDeviceInfo().device_type
     except Exception as e:
         print('GetDeviceType() : Exception =', e)
         return None
 
+  def LoadDeviceInfo(self):
+    """Identifies the receiver, reusing cached metadata where possible.
+
+    Metadata is looked up by the USB serial number, which costs no round
+    trip, and without one by the manufacturing serial number. It is only
+    reused when the raw firmware header still matches.
+    """
+    header = bytes(self.GenericReadCommand(constants.READ_FIRMWARE_HEADER).data)
+    usb_serial = util.usb_serial_number(self._port_name)
+    info = self._CachedDeviceInfo(('usb', usb_serial), header)
+    if info is None:
+      info = self._ClassifyFirmware(header)
+      self._UseDeviceInfo(info)
+      manufacturing_data = self.ReadManufacturingData()
+      serial = manufacturing_data.get('SerialNumber')
+      cached = self._CachedDeviceInfo(('serial', serial), header)
+      if cached is not None:
+        info = cached
+      else:
+        info.serial = serial
+        info.manufacturing_data = manufacturing_data
+      info.usb_serial = usb_serial
+      if self._device_info_cache is not None:
+        self._device_info_cache.put(info)
+    self._UseDeviceInfo(info)
+    return info
+
+  def _CachedDeviceInfo(self, key, header):
+    if self._device_info_cache is None:
+      return None
+    info = self._device_info_cache.get(key)
+    if info is not None and info.firmware_header != header:
+      self._device_info_cache.discard(info)
+      return None
+    return info
+
+  def _ClassifyFirmware(self, header):
+    fw_ver = ET.fromstring(header).get('FirmwareVersion')
+    if fw_ver.startswith("4."):   # Not sure about G4 firmware versions
+      return DeviceInfo(header, fw_ver, 'g4', self.G4_PARSER_MAP)
+    elif fw_ver.startswith("5.0."): # 5.0.1.043 = G5 Receiver Firmware
+      return DeviceInfo(header, fw_ver, 'g5', self.G5_PARSER_MAP)
+    elif fw_ver.startswith("5."):   # 5.1.1.022 = G6 Receiver Firmware
+      return DeviceInfo(header, fw_ver, 'g6', self.G6_PARSER_MAP)
+    else: # unrecognized firmware version
+      return DeviceInfo(header, fw_ver, fw_ver, None)
+
+  def _UseDeviceInfo(self, info):
+    self._device_info = info
+    if info.parser_map is not None:
+      self.PARSER_MAP = info.parser_map
+    if info.serial is not None:
+      self._serial = info.serial
+
   @classmethod
-  def LocateAndDownload(cls):
+  def LocateAndDownload(cls, cache_dir=None):
     device = cls.FindDevice()
     if not device:
       sys.stderr.write('Could not find Dexcom G4|G5|G6 Receiver!\n')
       sys.exit(1)
     else:
-      dex = cls(device)
+      page_cache = None
+      if cache_dir is not None:
+        page_cache = PageCache(max_bytes=64 * 1024 * 1024, directory=cache_dir)
+      dex = cls(device, page_cache=page_cache)
       # Uncomment two lines below to show the size of each record type
       #for item in dex.DataPartitions():
           #print item.attrib
@@ -221,15 +299,37 @@ class Dexcom(object):
                   #print 'sensorCode =', sen_rec.sensorCode
                   #print ''
 
-  def __init__(self, port_path, port=None):
+  def __init__(self, port_path, port=None, page_cache=None,
+               timeout=DEFAULT_TIMEOUT, timeouts=None, retries=2,
+               retry_backoff=0.2, device_info_cache=None, latencies=None):
     self._port_name = port_path
     self._port = port
+    self._transport = None
+    # replies still owed by the receiver for attempts that timed out
+    self._late_replies = 0
+    self.timeout = timeout
+    self.timeouts = dict(self.COMMAND_TIMEOUTS)
+    if timeouts:
+      self.timeouts.update(timeouts)
+    self.retries = retries
+    self.retry_backoff = retry_backoff
+    # response latency per command name
+    if latencies is None:
+      latencies = collections.defaultdict(util.LatencyHistogram)
+    self.latencies = latencies
+    self._page_cache = page_cache
+    self._page_ranges = {}
+    self._serial = None
+    self._device_info = None
+    self._device_info_cache = device_info_cache
     self.GetDeviceType()
 
   def Connect(self):
     try:
         if self._port is None:
-            self._port = serial.Serial(port=self._port_name, baudrate=115200)
+            self._port = serial.Serial(port=self._port_name, baudrate=115200,
+                                       timeout=FramedTransport.POLL_INTERVAL,
+                                       write_timeout=self.timeout)
     except serial.SerialException:
         try:
             if self._port is None:
@@ -240,7 +340,9 @@ class Dexcom(object):
                     # a subsequent serial port access work.
                     stat_info = os.stat(self._port_name)
                 time.sleep(15)
-                self._port = serial.Serial(port=self._port_name, baudrate=115200)
+                self._port = serial.Serial(port=self._port_name, baudrate=115200,
+                                       timeout=FramedTransport.POLL_INTERVAL,
+                                       write_timeout=self.timeout)
 
         except serial.SerialException:
             print('Read/Write permissions missing for', self._port_name)
@@ -296,6 +398,8 @@ class Dexcom(object):
           pass
       self._port.close()
     self._port = None
+    self._transport = None
+    self._late_replies = 0
 
   @property
   def port(self):
@@ -309,35 +413,82 @@ class Dexcom(object):
   def read(self, *args, **kwargs):
     return self.port.read(*args, **kwargs)
 
+  @property
+  def transport(self):
+    port = self.port
+    if self._transport is None or self._transport.port is not port:
+      self._transport = FramedTransport(port)
+    return self._transport
+
   def readpacket(self, timeout=None):
-    total_read = 4
-    initial_read = self.read(total_read)
-    all_data = initial_read
-    if initial_read[0] == 1:
-      command = initial_read[3]
-      data_number = struct.unpack('<H', initial_read[1:3])[0]
-      if data_number > 6:
-        toread = abs(data_number-6)
-        second_read = self.read(toread)
-        all_data += second_read
-        total_read += toread
-        out = second_read
-      else:
-        out =  ''
-      suffix = self.read(2)
-      sent_crc = struct.unpack('<H', suffix)[0]
-      local_crc = usbreceiver.crc16.crc16(all_data, 0, total_read)
-      if sent_crc != local_crc:
-        raise constants.CrcError("readpacket Failed CRC check")
-      num1 = total_read + 2
-      return ReadPacket(command, out)
-    else:
-      raise constants.Error('Error reading packet header!')
+    if timeout is None:
+      timeout = self.timeout
+    command, payload = self.transport.read_frame(time.monotonic() + timeout)
+    return ReadPacket(command, payload)
+
+  def resync(self):
+    try:
+      self.transport.resync()
+    except (serial.SerialException, OSError):
+      pass
+
+  def DrainLateReplies(self, timeout):
+    """Waits up to timeout for the replies to attempts that timed out."""
+    deadline = time.monotonic() + timeout
+    while self._late_replies > 0:
+      try:
+        self.transport.read_frame(deadline)
+      except constants.Error:
+        break
+      self._late_replies -= 1
+    self._late_replies = 0
+
+  def Exchange(self, command_id, packet, length=None):
+    """Sends a packet and reads the response within the command's timeout.
+
+    Replies still owed for attempts that timed out are read and dropped and
+    the input is resynchronized before every write, so a late reply to an
+    earlier attempt is not taken for the answer. A response that times out,
+    is corrupt or does not have the expected payload length fails the
+    attempt, read commands are then sent again up to `retries` times with
+    exponential backoff.
+    """
+    if length is None:
+      length = RESPONSE_LENGTHS.get(command_id)
+    histogram = self.latencies[COMMAND_NAMES.get(command_id, str(command_id))]
+    timeout = self.timeouts.get(command_id, self.timeout)
+    attempts = 1
+    if command_id in IDEMPOTENT_COMMANDS:
+      attempts += self.retries
+    for attempt in range(attempts):
+      try:
+        if self._late_replies:
+          self.DrainLateReplies(timeout)
+        self.resync()
+        ts_start = time.monotonic()
+        self.WritePacket(packet)
+        response = self.readpacket(timeout)
+        if (length is not None and response.command == constants.ACK
+            and len(response.data) != length):
+          raise constants.Error('Expected %d bytes in response to %s, got %d'
+                                % (length, COMMAND_NAMES.get(command_id, command_id),
+                                   len(response.data)))
+      except constants.Error as e:
+        if isinstance(e, constants.TimeoutError):
+          histogram.timeouts += 1
+          self._late_replies += 1
+        else:
+          histogram.errors += 1
+        if attempt + 1 >= attempts:
+          raise
+        time.sleep(self.retry_backoff * 2 ** attempt)
+        continue
+      histogram.observe(time.monotonic() - ts_start)
+      return response
 
   def Ping(self):
-    self.WriteCommand(constants.PING)
-    packet = self.readpacket()
-    return ord(packet.command) == constants.ACK
+    packet = self.Exchange(constants.PING, packetwriter.CachedPacket(constants.PING))
+    return packet.command == constants.ACK
 
   def WritePacket(self, packet):
     if not packet:
@@ -345,20 +496,16 @@ class Dexcom(object):
     packetlen = len(packet)
     if packetlen < 6 or packetlen > 1590:
       raise constants.Error('Invalid packet length')
-    self.flush()
-    self.write(packet)
+    self.transport.write_frame(packet)
 
   def WriteCommand(self, command_id, *args, **kwargs):
-    p = packetwriter.PacketWriter()
-    p.ComposePacket(command_id, *args, **kwargs)
-    self.WritePacket(p.get_packet_bytes())
+    self.WritePacket(packetwriter.EncodePacket(command_id, *args, **kwargs))
 
   def GenericReadCommand(self, command_id):
-    self.WriteCommand(command_id)
-    return self.readpacket()
+    return self.Exchange(command_id, packetwriter.CachedPacket(command_id))
 
   def ReadTransmitterId(self):
-    return self.GenericReadCommand(constants.READ_TRANSMITTER_ID).data
+    return bytes(self.GenericReadCommand(constants.READ_TRANSMITTER_ID).data)
 
   def ReadLanguage(self):
     lang = self.GenericReadCommand(constants.READ_LANGUAGE).data
@@ -370,7 +517,7 @@ class Dexcom(object):
 
   def ReadBatteryState(self):
     state = self.GenericReadCommand(constants.READ_BATTERY_STATE).data
-    return constants.BATTERY_STATES[ord(state)]
+    return constants.BATTERY_STATES[state[0]]
 
   def ReadRTC(self):
     rtc = self.GenericReadCommand(constants.READ_RTC).data
@@ -390,9 +537,9 @@ class Dexcom(object):
 
   def WriteDisplayTimeOffset(self, offset=None):
     payload = struct.pack('i', offset)
-    self.WriteCommand(constants.WRITE_DISPLAY_TIME_OFFSET, payload)
-    packet = self.readpacket()
-    return dict(ACK=ord(packet.command) == constants.ACK)
+    packet = self.Exchange(constants.WRITE_DISPLAY_TIME_OFFSET,
+                           packetwriter.EncodePacket(constants.WRITE_DISPLAY_TIME_OFFSET, payload))
+    return dict(ACK=packet.command == constants.ACK)
 
 
   def ReadDisplayTime(self):
@@ -401,16 +548,16 @@ class Dexcom(object):
   def ReadGlucoseUnit(self):
     UNIT_TYPE = (None, 'mg/dL', 'mmol/L')
     gu = self.GenericReadCommand(constants.READ_GLUCOSE_UNIT).data
-    return UNIT_TYPE[ord(gu[0])]
+    return UNIT_TYPE[gu[0]]
 
   def ReadClockMode(self):
     CLOCK_MODE = (24, 12)
     cm = self.GenericReadCommand(constants.READ_CLOCK_MODE).data
-    return CLOCK_MODE[ord(cm[0])]
+    return CLOCK_MODE[cm[0]]
 
   def ReadDeviceMode(self):
     # ???
-    return self.GenericReadCommand(constants.READ_DEVICE_MODE).data
+    return bytes(self.GenericReadCommand(constants.READ_DEVICE_MODE).data)
 
   def ReadBlindedMode(self):
     MODES = { 0: False }
@@ -419,23 +566,23 @@ class Dexcom(object):
     return mode
 
   def ReadHardwareBoardId(self):
-    return self.GenericReadCommand(constants.READ_HARDWARE_BOARD_ID).data
+    return bytes(self.GenericReadCommand(constants.READ_HARDWARE_BOARD_ID).data)
 
   def ReadEnableSetupWizardFlag (self):
     # ???
-    return self.GenericReadCommand(constants.READ_ENABLE_SETUP_WIZARD_FLAG).data
+    return bytes(self.GenericReadCommand(constants.READ_ENABLE_SETUP_WIZARD_FLAG).data)
 
   def ReadSetupWizardState (self):
     # ???
-    return self.GenericReadCommand(constants.READ_SETUP_WIZARD_STATE).data
+    return bytes(self.GenericReadCommand(constants.READ_SETUP_WIZARD_STATE).data)
 
   def WriteChargerCurrentSetting (self, status):
     MAP = ( 'Off', 'Power100mA', 'Power500mA', 'PowerMax', 'PowerSuspended' )
-    payload = str(bytearray([MAP.index(status)]))
-    self.WriteCommand(constants.WRITE_CHARGER_CURRENT_SETTING, payload)
-    packet = self.readpacket()
+    payload = bytes((MAP.index(status),))
+    packet = self.Exchange(constants.WRITE_CHARGER_CURRENT_SETTING,
+                           packetwriter.EncodePacket(constants.WRITE_CHARGER_CURRENT_SETTING, payload))
     raw = bytearray(packet.data)
-    return dict(ACK=ord(packet.command) == constants.ACK, raw=list(raw))
+    return dict(ACK=packet.command == constants.ACK, raw=list(raw))
 
   def ReadChargerCurrentSetting (self):
     MAP = ( 'Off', 'Power100mA', 'Power500mA', 'PowerMax', 'PowerSuspended' )
@@ -445,6 +592,9 @@ class Dexcom(object):
 
   # ManufacturingParameters: SerialNumber, HardwarePartNumber, HardwareRevision, DateTimeCreated, HardwareId
   def ReadManufacturingData(self):
+    info = self._device_info
+    if info is not None and info.manufacturing_data is not None:
+      return info.manufacturing_data
     data = self.ReadRecords('MANUFACTURING_DATA')[0].xmldata
     return ET.fromstring(data)
 
@@ -461,46 +611,121 @@ class Dexcom(object):
 
   def GetFirmwareHeader(self):
     i = self.GenericReadCommand(constants.READ_FIRMWARE_HEADER)
-    return ET.fromstring(i.data)
+    return ET.fromstring(bytes(i.data))
 
   # FirmwareSettingsParameters: FirmwareImageId
   def GetFirmwareSettings(self):
     i = self.GenericReadCommand(constants.READ_FIRMWARE_SETTINGS)
-    return ET.fromstring(i.data)
+    return ET.fromstring(bytes(i.data))
 
   def DataPartitions(self):
     i = self.GenericReadCommand(constants.READ_DATABASE_PARTITION_INFO)
-    return ET.fromstring(i.data)
+    return ET.fromstring(bytes(i.data))
+
+  @property
+  def device_info(self):
+    return self._device_info
+
+  @property
+  def serial(self):
+    if self._serial is None:
+      self._serial = self.ReadManufacturingData().get('SerialNumber')
+    return self._serial
+
+  def _PageCacheable(self, record_type):
+    # the serial number itself is read from MANUFACTURING_DATA
+    return self._page_cache is not None and record_type != 'MANUFACTURING_DATA'
 
   def ReadDatabasePageRange(self, record_type):
     record_type_index = constants.RECORD_TYPES.index(record_type)
-    self.WriteCommand(constants.READ_DATABASE_PAGE_RANGE,
-                      chr(record_type_index))
-    packet = self.readpacket()
-    return struct.unpack('II', packet.data)
+    packet = self.Exchange(constants.READ_DATABASE_PAGE_RANGE,
+                           packetwriter.CachedPacket(constants.READ_DATABASE_PAGE_RANGE,
+                                                     bytes((record_type_index,))))
+    page_range = struct.unpack('II', packet.data)
+    if self._PageCacheable(record_type):
+      previous = self._page_ranges.get(record_type)
+      if previous is None or previous[1] != page_range[1]:
+        # the last page is still being written to
+        self._page_cache.discard_from(self.serial, record_type, page_range[1])
+    self._page_ranges[record_type] = page_range
+    return page_range
 
   def ReadDatabasePage(self, record_type, page):
+    return self.ReadDatabasePages(record_type, page, 1)[0]
+
+  def ReadDatabasePages(self, record_type, first, count):
+    """Reads consecutive pages, several of them per command."""
     record_type_index = constants.RECORD_TYPES.index(record_type)
-    self.WriteCommand(constants.READ_DATABASE_PAGES,
-                      (chr(record_type_index), struct.pack('I', page), chr(1)))
-    packet = self.readpacket()
-    assert packet.command == 1
+    cache_keys = [None] * count
+    pages = [None] * count
+    if self._PageCacheable(record_type):
+      page_range = self._page_ranges.get(record_type)
+      for i in range(count):
+        page = first + i
+        if page_range is not None and page_range[0] <= page < page_range[1]:
+          cache_keys[i] = (self.serial, record_type, page)
+          pages[i] = self._page_cache.get(cache_keys[i])
+
+    i = 0
+    while i < count:
+      if pages[i] is not None:
+        i += 1
+        continue
+      n = 1
+      while (n < constants.MAX_PAGES_PER_READ and i + n < count
+             and pages[i + n] is None):
+        n += 1
+      packet = self.Exchange(constants.READ_DATABASE_PAGES, packetwriter.EncodePacket(
+        constants.READ_DATABASE_PAGES, struct.pack('<BIB', record_type_index, first + i, n)),
+        n * constants.DATABASE_PAGE_SIZE)
+      assert packet.command == 1
+      # records keep referring to the pages, so they are copied out of the
+      # transport buffer
+      data = bytes(packet.data)
+      page_size = len(data) // n
+      if page_size * n != len(data):
+        raise constants.Error('Unexpected size %d for %d pages' % (len(data), n))
+      for k in range(n):
+        pages[i + k] = data[k * page_size:(k + 1) * page_size]
+        if cache_keys[i + k] is not None:
+          self._page_cache.put(cache_keys[i + k], pages[i + k])
+      i += n
+
+    return [self._ParsePageData(record_type_index, first + i, data)
+            for i, data in enumerate(pages)]
+
+  def _ParsePageData(self, record_type_index, page, data):
     # first index (uint), numrec (uint), record_type (byte), revision (byte),
     # page# (uint), r1 (uint), r2 (uint), r3 (uint), ushort (Crc)
     header_format = '<2IcB4IH'
     header_data_len = struct.calcsize(header_format)
-    header = struct.unpack_from(header_format, packet.data)
-    header_crc = usbreceiver.crc16.crc16(packet.data[:header_data_len - 2])
-    assert header_crc == header[-1]
+    header = struct.unpack_from(header_format, data)
+    header_crc = usbreceiver.crc16.crc16(data, 0, header_data_len - 2)
+    if header_crc != header[-1]:
+      raise constants.CrcError('Page %d header failed CRC check' % page)
     assert ord(header[2]) == record_type_index
     assert header[4] == page
-    packet_data = packet.data[header_data_len:]
-
-    return self.ParsePage(header, packet_data)
+    return self.ParsePage(header, data[header_data_len:])
+
+  def IterPages(self, record_type, start, end, reverse=False):
+    """Yields (page, records) for start <= page < end."""
+    step = constants.MAX_PAGES_PER_READ
+    if reverse:
+      for last in range(end, start, -step):
+        first = max(start, last - step)
+        for i, records in reversed(list(enumerate(
+            self.ReadDatabasePages(record_type, first, last - first)))):
+          yield first + i, records
+    else:
+      for first in range(start, end, step):
+        count = min(step, end - first)
+        for i, records in enumerate(self.ReadDatabasePages(record_type, first, count)):
+          yield first + i, records
 
   def GenericRecordYielder(self, header, data, record_type):
-    for x in xrange(header[1]):
-      yield record_type.Create(data, x)
+    if decodes_in_bulk(record_type):
+      return RecordPage(record_type, data, header[1])
+    return (record_type.Create(data, x) for x in xrange(header[1]))
 
   def ParsePage(self, header, data):
     record_type = constants.RECORD_TYPES[ord(header[2])]
@@ -532,8 +757,8 @@ class Dexcom(object):
     start, end = page_range
     if start != end or not end:
       end += 1
-    for x in reversed(xrange(start, end)):
-      records = list(self.ReadDatabasePage(record_type, x))
+    for _, page_records in self.IterPages(record_type, start, end, reverse=True):
+      records = list(page_records)
       records.reverse( )
       for record in records:
         yield record
@@ -545,6 +770,6 @@ class Dexcom(object):
     start, end = page_range
     if start != end or not end:
       end += 1
-    for x in range(start, end):
-      records.extend(self.ReadDatabasePage(record_type, x))
+    for _, page_records in self.IterPages(record_type, start, end):
+      records.extend(page_records)
     return records
\ No newline at end of file
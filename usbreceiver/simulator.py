@@ -0,0 +1,331 @@
+"""Dexcom G6 receiver simulator on a pseudo-terminal.
+
+Serves the receiver protocol from a synthetic EGV database that grows by one
+record per interval, so Dexcom and DexcomReceiverSession can be run and
+measured without a receiver:
+
+  python -m usbreceiver.simulator --latency-ms 2
+  python -m usbreceiver.simulator --benchmark
+"""
+import argparse
+import math
+import os
+import pty
+import random
+import struct
+import sys
+import threading
+import time
+import tty
+
+import usbreceiver.crc16
+
+from usbreceiver import constants, database_records, packetwriter
+
+FIRMWARE_HEADER = (
+  '<FirmwareHeader SchemaVersion="1" ApiVersion="3.1.0.0" TestApiVersion="3.5.0.0"'
+  ' ProductId="G6Receiver" ProductName="Dexcom G6 Receiver" SoftwareNumber="SW11163"'
+  ' FirmwareVersion="5.1.1.022" PortVersion="4.6.4.45" RFVersion="1.0.0.27"'
+  ' DexBootVersion="13" />')
+
+PAGE_HEADER_FORMAT = '<2IcB4I'
+PAGE_DATA_SIZE = constants.DATABASE_PAGE_SIZE - struct.calcsize(PAGE_HEADER_FORMAT) - 2
+EMPTY_RANGE = (0xFFFFFFFF, 0xFFFFFFFF)
+
+
+def _with_crc(data):
+  return data + struct.pack('<H', usbreceiver.crc16.crc16(data))
+
+
+class SimulatedDatabase(object):
+  """EGV_DATA partition with one G5EGVRecord per interval up to now.
+
+  The receiver clock runs clock_offset seconds behind the host clock. Record
+  values follow a slow sine with some noise and are derived from the record
+  index, so every page reads the same each time.
+  """
+
+  RECORD = database_records.G5EGVRecord
+  RECORD_FORMAT = RECORD.FORMAT[:-1]
+
+  def __init__(self, history=24 * 60 * 60, interval=300, clock_offset=0.0,
+               serial='SM12345678', transmitter_id='8G1234', seed=0):
+    self.interval = interval
+    self.clock_offset = clock_offset
+    self.serial = serial
+    self.transmitter_id = transmitter_id
+    self.seed = seed
+    self.record_size = self.RECORD._ClassSize()
+    self.records_per_page = PAGE_DATA_SIZE // self.record_size
+    self.ts_first = self.system_time() - history
+
+  def system_time(self, ts_now=None):
+    if ts_now is None:
+      ts_now = time.time()
+    return int(ts_now - self.clock_offset - constants.DEXCOM_EPOCH)
+
+  def record_count(self):
+    return max(0, (self.system_time() - self.ts_first) // self.interval + 1)
+
+  def record(self, index):
+    rtime = self.ts_first + index * self.interval
+    rnd = random.Random(self.seed * 1000003 + index)
+    glucose = int(140 + 60 * math.sin(index / 20.0) + rnd.uniform(-5, 5))
+    trend = 4 + max(-3, min(3, int(-3 * math.cos(index / 20.0))))
+    return _with_crc(struct.pack(self.RECORD_FORMAT, rtime, rtime + 3600, glucose,
+                                 rtime, 0, index & database_records.EGV_TESTNUM_MASK,
+                                 trend, 0, 0))
+
+  def page_range(self, record_type):
+    if record_type == 'EGV_DATA':
+      count = self.record_count()
+      if count == 0:
+        return EMPTY_RANGE
+      return 0, (count - 1) // self.records_per_page
+    if record_type == 'MANUFACTURING_DATA':
+      return 0, 0
+    return EMPTY_RANGE
+
+  def page(self, record_type, page):
+    record_type_index = constants.RECORD_TYPES.index(record_type)
+    if record_type == 'EGV_DATA':
+      first = page * self.records_per_page
+      count = max(0, min(self.records_per_page, self.record_count() - first))
+      data = b''.join(self.record(first + i) for i in range(count))
+    elif record_type == 'MANUFACTURING_DATA' and page == 0:
+      first, count = 0, 1
+      xml = ('<ManufacturingParameters SerialNumber="%s" HardwarePartNumber="MT24664"'
+             ' HardwareRevision="11" DateTimeCreated="2019-01-01 00:00:00.000"'
+             ' HardwareId="{00000000-0000-0000-0000-000000000000}" />' % self.serial)
+      data = _with_crc(struct.pack('<II490s', 0, 0, xml.encode('utf-8')))
+    else:
+      raise ValueError('no page %d of %s' % (page, record_type))
+    header = _with_crc(struct.pack(PAGE_HEADER_FORMAT, first, count,
+                                   bytes((record_type_index,)), 1, page, 0, 0, 0))
+    return header + data + b'\xff' * (PAGE_DATA_SIZE - len(data))
+
+  def partitions(self):
+    return ('<DatabasePartitions SchemaVersion="1" PageHeaderVersion="1" PageDataLength="%d">'
+            '<Partition Name="MANUFACTURING_DATA" Id="0" RecordRevision="1" RecordLength="500" />'
+            '<Partition Name="EGV_DATA" Id="4" RecordRevision="4" RecordLength="%d" />'
+            '</DatabasePartitions>' % (PAGE_DATA_SIZE, self.record_size))
+
+
+class ReceiverSimulator(object):
+  """Answers receiver commands on the master side of a pty.
+
+  latency delays every response. A response is corrupted with corrupt_rate
+  probability, and with stall_rate probability the receiver stops after half
+  a frame and stays silent for stall_seconds.
+  """
+
+  def __init__(self, database=None, latency=0.0, corrupt_rate=0.0, stall_rate=0.0,
+               stall_seconds=3.0, seed=None):
+    self.database = database if database is not None else SimulatedDatabase()
+    self.latency = latency
+    self.corrupt_rate = corrupt_rate
+    self.stall_rate = stall_rate
+    self.stall_seconds = stall_seconds
+    self.random = random.Random(seed)
+    self.commands = 0
+    self.corrupted = 0
+    self.stalls = 0
+    self.port_path = None
+    self._master = None
+    self._slave = None
+    self._thread = None
+    self._running = False
+
+  def start(self):
+    self._master, self._slave = pty.openpty()
+    tty.setraw(self._slave)
+    self.port_path = os.ttyname(self._slave)
+    self._running = True
+    self._thread = threading.Thread(target=self.run, name="receiver-simulator")
+    self._thread.daemon = True
+    self._thread.start()
+    return self.port_path
+
+  def stop(self):
+    self._running = False
+    for fd in (self._slave, self._master):
+      if fd is not None:
+        try:
+          os.close(fd)
+        except OSError:
+          pass
+    self._master = self._slave = None
+
+  def run(self):
+    buf = bytearray()
+    while self._running:
+      try:
+        data = os.read(self._master, 4096)
+      except OSError:
+        break
+      if not data:
+        break
+      buf += data
+      while True:
+        frame = self._next_frame(buf)
+        if frame is None:
+          break
+        self._respond(*frame)
+
+  @staticmethod
+  def _next_frame(buf):
+    # drops bytes until a frame with a good CRC starts the buffer
+    while buf:
+      if buf[0] != packetwriter.PacketWriter.SOF:
+        del buf[0]
+        continue
+      if len(buf) < 3:
+        return None
+      length = buf[1] | (buf[2] << 8)
+      if length < packetwriter.PacketWriter.MIN_LEN or length > packetwriter.PacketWriter.MAX_LEN:
+        del buf[0]
+        continue
+      if len(buf) < length:
+        return None
+      frame = bytes(buf[:length])
+      if usbreceiver.crc16.crc16(frame, 0, length - 2) != struct.unpack_from('<H', frame, length - 2)[0]:
+        del buf[0]
+        continue
+      del buf[:length]
+      return frame[3], frame[4:length - 2]
+    return None
+
+  def handle(self, command, payload):
+    """Returns (response command, payload) for a request."""
+    db = self.database
+    if command == constants.PING:
+      return constants.ACK, b''
+    if command == constants.READ_FIRMWARE_HEADER:
+      return constants.ACK, FIRMWARE_HEADER.encode('utf-8')
+    if command == constants.READ_DATABASE_PARTITION_INFO:
+      return constants.ACK, db.partitions().encode('utf-8')
+    if command in (constants.READ_SYSTEM_TIME, constants.READ_RTC):
+      return constants.ACK, struct.pack('<I', db.system_time())
+    if command in (constants.READ_SYSTEM_TIME_OFFSET, constants.READ_DISPLAY_TIME_OFFSET):
+      return constants.ACK, struct.pack('<i', 0)
+    if command == constants.READ_TRANSMITTER_ID:
+      return constants.ACK, db.transmitter_id.encode('ascii')
+    if command == constants.READ_BATTERY_LEVEL:
+      return constants.ACK, struct.pack('<I', 87)
+    if command == constants.READ_BATTERY_STATE:
+      return constants.ACK, bytes((2,))
+    if command == constants.READ_DATABASE_PAGE_RANGE and len(payload) == 1:
+      return constants.ACK, struct.pack('<II', *db.page_range(constants.RECORD_TYPES[payload[0]]))
+    if command == constants.READ_DATABASE_PAGES and len(payload) == 6:
+      record_type_index, first, count = struct.unpack('<BIB', payload)
+      record_type = constants.RECORD_TYPES[record_type_index]
+      start, end = db.page_range(record_type)
+      if (not 1 <= count <= constants.MAX_PAGES_PER_READ or start == EMPTY_RANGE[0]
+          or first < start or first + count - 1 > end):
+        return constants.INVALID_PARAM, b''
+      return constants.ACK, b''.join(db.page(record_type, first + i) for i in range(count))
+    return constants.INVALID_COMMAND, b''
+
+  def _respond(self, command, payload):
+    self.commands += 1
+    response_command, response = self.handle(command, payload)
+    packet = bytearray(packetwriter.EncodePacket(response_command, response))
+    if self.latency:
+      time.sleep(self.latency)
+    if self.stall_rate and self.random.random() < self.stall_rate:
+      self.stalls += 1
+      self._write(packet[:len(packet) // 2])
+      time.sleep(self.stall_seconds)
+      return
+    if self.corrupt_rate and self.random.random() < self.corrupt_rate:
+      self.corrupted += 1
+      packet[self.random.randrange(packetwriter.PacketWriter.OFFSET_PAYLOAD, len(packet))] ^= 0x5a
+    self._write(packet)
+
+  def _write(self, data):
+    view = memoryview(data)
+    while view:
+      try:
+        n = os.write(self._master, view)
+      except OSError:
+        return
+      view = view[n:]
+
+
+def benchmark(simulator, polls=20):
+  from usbreceiver.readdata import Dexcom
+
+  results = {}
+  dex = Dexcom(simulator.port_path)
+  try:
+    ts_start = time.perf_counter()
+    records = dex.ReadRecords('EGV_DATA')
+    seconds = time.perf_counter() - ts_start
+    pages = dex.ReadDatabasePageRange('EGV_DATA')[1] + 1
+    results['full_read'] = dict(records=len(records), pages=pages, seconds=round(seconds, 4),
+                                records_per_second=round(len(records) / seconds),
+                                bytes_per_second=round(pages * constants.DATABASE_PAGE_SIZE / seconds))
+    results['commands'] = dict((name, dict(count=h.count, p50=h.quantile(0.5), p99=h.quantile(0.99),
+                                           timeouts=h.timeouts, errors=h.errors))
+                               for name, h in dex.latencies.items())
+  finally:
+    dex.Disconnect()
+
+  from dexcom_receiver import DexcomReceiverSession
+
+  batches = []
+  session = DexcomReceiverSession(batches.append, port_path=simulator.port_path)
+  durations = []
+  try:
+    for _ in range(polls):
+      ts_start = time.perf_counter()
+      session.poll()
+      durations.append(time.perf_counter() - ts_start)
+  finally:
+    session.disconnect()
+  durations.sort()
+  results['poll'] = dict(polls=polls, max=round(durations[-1], 4),
+                         p50=round(durations[len(durations) // 2], 4),
+                         values=sum(len(b) for b in batches))
+  results['simulator'] = dict(commands=simulator.commands, corrupted=simulator.corrupted,
+                              stalls=simulator.stalls)
+  return results
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Dexcom G6 receiver simulator on a pty')
+  parser.add_argument('--history-hours', type=float, default=24)
+  parser.add_argument('--interval', type=int, default=300, help='seconds between records')
+  parser.add_argument('--clock-offset', type=float, default=0.0)
+  parser.add_argument('--latency-ms', type=float, default=0.0)
+  parser.add_argument('--corrupt-rate', type=float, default=0.0)
+  parser.add_argument('--stall-rate', type=float, default=0.0)
+  parser.add_argument('--stall-seconds', type=float, default=3.0)
+  parser.add_argument('--seed', type=int, default=None)
+  parser.add_argument('--benchmark', action='store_true',
+                      help='read from the simulator and print throughput and poll latency')
+  args = parser.parse_args(argv)
+
+  database = SimulatedDatabase(history=int(args.history_hours * 3600), interval=args.interval,
+                               clock_offset=args.clock_offset)
+  simulator = ReceiverSimulator(database, latency=args.latency_ms / 1000,
+                                corrupt_rate=args.corrupt_rate, stall_rate=args.stall_rate,
+                                stall_seconds=args.stall_seconds, seed=args.seed)
+  port_path = simulator.start()
+  try:
+    if args.benchmark:
+      import json
+      print(json.dumps(benchmark(simulator), indent=2))
+    else:
+      print('simulated receiver on %s' % port_path)
+      sys.stdout.flush()
+      while True:
+        time.sleep(3600)
+  except KeyboardInterrupt:
+    pass
+  finally:
+    simulator.stop()
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,63 @@
+import time
+
+import usbreceiver.crc16
+
+from usbreceiver import constants
+from usbreceiver.packetwriter import PacketWriter
+
+
+class FramedTransport(object):
+  """Reads receiver response frames into a preallocated buffer.
+
+  The whole frame is read into the same bytearray each time and checked in
+  place, payloads are returned as memoryviews into that buffer and are only
+  valid until the next frame is read.
+
+  Reads wait on the port in short slices so a deadline is honoured even
+  when the receiver stops in the middle of a frame.
+  """
+
+  POLL_INTERVAL = 0.1
+
+  def __init__(self, port):
+    self.port = port
+    self._buf = bytearray(PacketWriter.MAX_LEN)
+    self._view = memoryview(self._buf)
+    if getattr(port, 'timeout', 0) is None:
+      port.timeout = self.POLL_INTERVAL
+
+  def _fill(self, start, end, deadline):
+    view = self._view[start:end]
+    while view:
+      n = self.port.readinto(view)
+      if n:
+        view = view[n:]
+      elif deadline is None or time.monotonic() >= deadline:
+        raise constants.TimeoutError('Timed out after %d of %d bytes'
+                                     % (end - len(view), end))
+
+  def read_frame(self, deadline=None):
+    """Returns (command, payload) of the next frame.
+
+    deadline is a time.monotonic() value, without one a read that returns
+    nothing fails right away.
+    """
+    buf = self._buf
+    self._fill(0, PacketWriter.OFFSET_PAYLOAD, deadline)
+    if buf[PacketWriter.OFFSET_SOF] != PacketWriter.SOF:
+      raise constants.Error('Error reading packet header!')
+    length = buf[1] | (buf[2] << 8)
+    if length < PacketWriter.MIN_LEN or length > PacketWriter.MAX_LEN:
+      raise constants.Error('Invalid packet length %d' % length)
+    self._fill(PacketWriter.OFFSET_PAYLOAD, length, deadline)
+    if usbreceiver.crc16.crc16(buf, 0, length - 2) != buf[length - 2] | (buf[length - 1] << 8):
+      raise constants.CrcError('readpacket Failed CRC check')
+    return (buf[PacketWriter.OFFSET_CMD],
+            self._view[PacketWriter.OFFSET_PAYLOAD:length - 2])
+
+  def write_frame(self, packet):
+    self.port.write(packet)
+
+  def resync(self):
+    """Drops whatever is left of a partial or corrupt frame."""
+    self.port.reset_input_buffer()
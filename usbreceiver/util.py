@@ -28,6 +28,7 @@
 #########################################################################
 
 import usbreceiver.constants
+import bisect
 import datetime
 import os
 import platform
@@ -47,6 +48,40 @@ def ReceiverTimeToTime(rtime):
   return constants.DEXCOM_EPOCH + rtime
 
 
+class LatencyHistogram(object):
+  """Cumulative latency histogram over fixed bucket bounds in seconds."""
+
+  BOUNDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+  def __init__(self, bounds=BOUNDS):
+    self.bounds = bounds
+    self.counts = [0] * (len(bounds) + 1)
+    self.count = 0
+    self.sum = 0.0
+    self.errors = 0
+    self.timeouts = 0
+
+  def observe(self, seconds):
+    self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+    self.count += 1
+    self.sum += seconds
+
+  def buckets(self):
+    """(upper bound, cumulative count) pairs, the last bound is infinite."""
+    total = 0
+    for bound, n in zip(self.bounds + (float('inf'),), self.counts):
+      total += n
+      yield bound, total
+
+  def quantile(self, q):
+    """Upper bound of the bucket holding the q-quantile."""
+    if not self.count:
+      return None
+    for bound, total in self.buckets():
+      if total >= q * self.count:
+        return bound
+
+
 def linux_find_usbserial(vendor, product):
   DEV_REGEX = re.compile('^tty(USB|ACM)[0-9]+$')
   for usb_dev_root in os.listdir('/sys/bus/usb/devices'):
@@ -65,6 +100,24 @@ def linux_find_usbserial(vendor, product):
           return os.path.join('/dev', option)
 
 
+def linux_usb_serial_number(port_path, sysfs_root='/sys'):
+  # /sys/class/tty/ttyACM0/device is the USB interface, its parent the device
+  interface = os.path.realpath(os.path.join(sysfs_root, 'class', 'tty',
+                                            os.path.basename(port_path), 'device'))
+  try:
+    with open(os.path.join(os.path.dirname(interface), 'serial')) as f:
+      return f.read().strip() or None
+  except (OSError, IOError):
+    return None
+
+
+def usb_serial_number(port_path):
+  """USB serial number of the device behind a tty, None if unknown."""
+  if port_path is None or platform.system() != 'Linux':
+    return None
+  return linux_usb_serial_number(port_path)
+
+
 def osx_find_usbserial(vendor, product):
   def recur(v):
     if hasattr(v, '__iter__') and 'idVendor' in v and 'idProduct' in v: